@@ -0,0 +1,222 @@
+"""
+Agent of a distributed run. Connects to the coordinator (run.py --listen
+ADDRESS) and runs the units of work it's given, one at a time, like a
+parallel worker. The logs are sent to the coordinator as they are written,
+the result of every test case as soon as it completes, the results of the
+files when the unit completes and the failed test cases as they happen. A
+cancel from the coordinator (--maxfail reached) stops the unit like a worker
+of a parallel run.
+
+    TAURUS_AGENT_TOKEN=<token of the run> python agent.py HOST:PORT
+    TAURUS_AGENT_TOKEN=<token of the run> python agent.py unix:/path/to/socket
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import traceback
+from multiprocessing.managers import SyncManager
+from typing import Dict
+
+from cancellation import FailureLimit
+from protocol import TOKEN_ENV, connect, recv_message, send_message
+from run import run_test_case_files_worker
+from selection import Selection
+
+
+class LogStreamer:
+    """
+    Send what's written to the files under log_dir to the coordinator, as
+    paths relative to log_dir
+    """
+
+    def __init__(self, sock: socket.socket, send_lock: threading.Lock, log_dir: str,
+                 interval: float = 0.2) -> None:
+        self.sock = sock
+        self.send_lock = send_lock
+        self.log_dir = log_dir
+        self.interval = interval
+        # bytes of every file sent so far
+        self.offsets: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='log-streamer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # send what's left once the unit is done
+        self._stop.set()
+        self._thread.join()
+        self.scan()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.scan()
+
+    def scan(self):
+        for dir_name, _, file_names in os.walk(self.log_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_name, file_name)
+                offset = self.offsets.get(path, 0)
+                try:
+                    with open(path, 'rb') as fd:
+                        fd.seek(offset)
+                        data = fd.read()
+                except OSError:
+                    continue
+                if not data:
+                    continue
+                self.offsets[path] = offset + len(data)
+                with self.send_lock:
+                    send_message(self.sock, {
+                        'type': 'log',
+                        'path': os.path.relpath(path, self.log_dir),
+                        'data': base64.b64encode(data).decode(),
+                    })
+
+
+def _remote_path(path: str, local_log_dir: str, log_dir: str) -> str:
+    # path of the log on the coordinator
+    if path and path.startswith(local_log_dir):
+        return log_dir + path[len(local_log_dir):]
+    return path
+
+
+def _test_case_json(tc: dict, local_log_dir: str, log_dir: str) -> dict:
+    for key in ('log_dir', 'log_file', 'profile_file'):
+        tc[key] = _remote_path(tc[key], local_log_dir, log_dir)
+    return tc
+
+
+def _result_json(result: dict, local_log_dir: str, log_dir: str) -> dict:
+    test_cases = [_test_case_json(tc.to_json(), local_log_dir, log_dir)
+                  for tc in result['test_cases']]
+    return {
+        'args': vars(result['args']),
+        'log_dir': _remote_path(result['log_dir'], local_log_dir, log_dir),
+        'start_time': str(result['start_time']),
+        'end_time': str(result['end_time']),
+        'duration': result['duration'],
+        'hooks': result['hooks'],
+        'hook_usage': result['hook_usage'],
+        'test_cases': test_cases,
+    }
+
+
+def _send_test_cases(sock: socket.socket, send_lock: threading.Lock, results: queue.Queue,
+                     local_log_dir: str, log_dir: str):
+    # the results of the test cases completed so far
+    while True:
+        try:
+            tc = results.get_nowait()
+        except queue.Empty:
+            return
+        shard = tc.pop('shard')
+        with send_lock:
+            send_message(sock, {'type': 'test_case', 'shard': shard,
+                                'test_case': _test_case_json(tc, local_log_dir, log_dir)})
+
+
+def _wait_unit(sock: socket.socket, send_lock: threading.Lock,
+               future: concurrent.futures.Future, failure_limit: FailureLimit,
+               results: queue.Queue, local_log_dir: str, log_dir: str):
+    # send the results of the test cases and report the failed ones to the
+    # coordinator as they happen, it counts them for --maxfail of the whole
+    # run. The results are all in the queue once the unit is done
+    sent = failure_limit.count if failure_limit else 0
+    while True:
+        try:
+            return future.result(timeout=0.2)
+        except concurrent.futures.TimeoutError:
+            pass
+        finally:
+            _send_test_cases(sock, send_lock, results, local_log_dir, log_dir)
+            count = failure_limit.count if failure_limit else 0
+            if count > sent:
+                with send_lock:
+                    send_message(sock, {'type': 'failures', 'count': count - sent})
+                sent = count
+
+
+def run_unit(sock: socket.socket, send_lock: threading.Lock,
+             executor: concurrent.futures.Executor, message: dict,
+             results: queue.Queue, failure_limit: FailureLimit = None):
+    args = argparse.Namespace(**message['args'])
+    selection = Selection.from_json(message['selection']) if message['selection'] else None
+    shard = tuple(message['shard']) if message['shard'] else None
+    # the test case files are expected at the same paths as on the coordinator
+    cwd = message['cwd'] if os.path.isdir(message['cwd']) else os.getcwd()
+    reply = {'type': 'result', 'unit_id': message['unit_id']}
+    with tempfile.TemporaryDirectory(prefix='taurus-agent-') as local_log_dir:
+        streamer = LogStreamer(sock, send_lock, local_log_dir)
+        streamer.start()
+        try:
+            future = executor.submit(run_test_case_files_worker, message['file_names'], args,
+                                     local_log_dir, cwd, selection,
+                                     message['framework_session_setup_output'], None, shard,
+                                     failure_limit, results, message['argv'])
+            file_results = _wait_unit(sock, send_lock, future, failure_limit, results,
+                                      local_log_dir, message['log_dir'])
+            reply['results'] = [_result_json(result, local_log_dir, message['log_dir'])
+                                for result in file_results]
+        except Exception:
+            reply['error'] = traceback.format_exc()
+        finally:
+            streamer.stop()
+    with send_lock:
+        send_message(sock, reply)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    sock = connect(sys.argv[1])
+    send_lock = threading.Lock()
+    send_message(sock, {'type': 'hello', 'host': socket.gethostname(), 'pid': os.getpid(),
+                        'token': os.environ.get(TOKEN_ENV, '')})
+    manager = None
+    unit, failure_limit = None, None
+    # the worker process (and the manager) close their copy of the connection,
+    # the coordinator sees the agent is gone when the agent dies even if the
+    # worker doesn't
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=sock.close) as executor:
+        # the unit is run in a thread, the messages (cancel) are read while
+        # it runs
+        while True:
+            try:
+                message = recv_message(sock)
+            except ConnectionError:
+                break
+            if message['type'] == 'exit':
+                break
+            if message['type'] == 'run':
+                failure_limit = None
+                if manager is None:
+                    manager = SyncManager()
+                    manager.start(sock.close)
+                if message['maxfail']:
+                    failure_limit = FailureLimit.shared(manager, message['maxfail'])
+                    failure_limit.add(message['failures'])
+                unit = threading.Thread(target=run_unit, name='agent-unit', daemon=True,
+                                        args=(sock, send_lock, executor, message,
+                                              manager.Queue(), failure_limit))
+                unit.start()
+            elif message['type'] == 'cancel' and failure_limit:
+                failure_limit.stop()
+        if unit:
+            unit.join()
+    if manager:
+        manager.shutdown()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Measure the overhead of the runner itself. Synthetic test case files with
+empty test cases are generated and for each file size the benchmark measures
+
+* discovery - ast discovery of the file, discovery from the cache and the
+  import of the file (with the TestCase objects)
+* run - the run of the file by the runner (run.py), the time per test case is
+  the runner's overhead as the test cases do nothing
+* memory - the peak RSS of the run
+* report - the time to build report.json/summary.txt from the results
+
+Every size is measured in a new process, so the runs don't share the memory
+or the state of the loggers, --repeat times and the median of every metric is
+kept. The results are written as json that can be compared with the results
+of another version to catch regressions, differences too small to tell from
+the noise (MIN_DIFF) are not reported
+
+    python benchmark.py --sizes 10 1000 100000 -o new.json
+    python benchmark.py -o new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+# version of the result format
+RESULT_VERSION = 1
+# metrics compared with --compare, a larger value is worse
+METRICS = ['discovery_secs', 'discovery_cached_secs', 'import_secs',
+           'run_secs', 'per_case_ms', 'report_secs', 'max_rss_kb']
+# smallest difference of each metric that is compared with the threshold,
+# a few microseconds of discovery from the cache vary by more than 20%. The
+# whole run is noisier, per_case_ms gets the run_secs one per test case
+MIN_DIFF = {'discovery_secs': 0.001, 'discovery_cached_secs': 0.001, 'import_secs': 0.001,
+            'run_secs': 0.01, 'report_secs': 0.001, 'max_rss_kb': 1024}
+
+
+def generate_test_case_file(dir_name: str, size: int) -> str:
+    """
+    Write a test case file with size empty test cases, return its path
+    """
+    file_name = os.path.join(dir_name, f"bench_{size}.py")
+    with open(file_name, 'w') as fd:
+        fd.write(f'"""\nBenchmark module with {size} empty test cases\n"""\n\n')
+        for idx in range(size):
+            fd.write(f"\ndef test_{idx:06d}(tc):\n    pass\n")
+    return file_name
+
+
+def _median_time(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def measure(file_name: str, repeat: int) -> Dict:
+    """
+    Measure one test case file, run in its own process from the directory
+    the logs are written to
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from discovery import DiscoveryCache, discover_file
+    from report import Report
+    from run import Runner
+    from testcase_file import TestCaseFile
+
+    result: Dict = {}
+    result['discovery_secs'] = _median_time(lambda: discover_file(file_name), repeat)
+    cache = DiscoveryCache(os.path.join('logs', '.taurus-cache', 'discovery.json'))
+    cache.discover(file_name)
+    result['discovery_cached_secs'] = _median_time(lambda: cache.discover(file_name), repeat)
+    result['import_secs'] = _median_time(
+        lambda: TestCaseFile(file_name).test_case_list, repeat)
+
+    sys.argv = ['run.py', file_name]
+    runner = Runner()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        # the runner logs every test case to the console
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            runner.main()
+    result['run_secs'] = time.perf_counter() - start
+    # the results of the file are dropped once they are in the report
+    result['test_cases'] = len(runner.test_case_files[0].list_test_cases())
+    result['per_case_ms'] = result['run_secs'] * 1000 / max(result['test_cases'], 1)
+    # kb on linux
+    result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['rss_growth_kb'] = result['max_rss_kb'] - start_rss
+
+    log_dir = os.path.realpath(os.path.join('logs', 'latest'))
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            result['report_secs'] = _median_time(lambda: Report(log_dir), repeat)
+    return result
+
+
+def run_benchmark(sizes: List[int], repeat: int) -> Dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='taurus-bench-') as work_dir:
+        for size in sizes:
+            size_dir = os.path.join(work_dir, str(size))
+            os.makedirs(size_dir)
+            file_name = generate_test_case_file(size_dir, size)
+            result_file = os.path.join(size_dir, 'result.json')
+            runs = []
+            for run in range(repeat):
+                print(f"Measuring {size} test cases ({run + 1}/{repeat})", file=sys.stderr)
+                subprocess.run([sys.executable, os.path.abspath(__file__),
+                                '--measure', file_name, '--result-file', result_file,
+                                '--repeat', str(repeat)],
+                               cwd=size_dir, check=True)
+                with open(result_file) as fd:
+                    runs.append(json.load(fd))
+            results[str(size)] = {key: statistics.median(run[key] for run in runs)
+                                  for key in runs[0]}
+    return {
+        'version': RESULT_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d-%H-%M-%S'),
+        'results': results,
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Metrics of the current results that are worse than the baseline by more
+    than threshold (0.2 is 20%) and by more than their MIN_DIFF
+    """
+    regressions = []
+    for size, result in current['results'].items():
+        base = baseline['results'].get(size)
+        if not base:
+            continue
+        for metric in METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            line = f"{size:>8} {metric:<22} {old:>12.4f} {new:>12.4f} {change:>+8.1%}"
+            print(line)
+            if metric == 'per_case_ms':
+                min_diff = MIN_DIFF['run_secs'] * 1000 / int(size)
+            else:
+                min_diff = MIN_DIFF[metric]
+            if change > threshold and new - old >= min_diff:
+                regressions.append(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the runner's overhead")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='Number of test cases of the generated files (default 10 100 1000 10000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repeat the measurements, the median is kept (default 3)')
+    parser.add_argument('-o', '--output', help='Write the results to this json file')
+    parser.add_argument('--compare', help='Results json of an earlier version to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slow down (fraction) reported as a regression (default 0.2)')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # run by run_benchmark for one size
+        result = measure(args.measure, args.repeat)
+        with open(args.result_file, 'w') as fd:
+            json.dump(result, fd)
+        return
+
+    current = run_benchmark(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(current, fd, indent=4)
+    else:
+        print(json.dumps(current, indent=4))
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+            for line in regressions:
+                print(line)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Stop the run early (--exitfirst, --maxfail). Once the number of failed (or
+timed out) test cases reaches the limit no new test case or test case file
+is started. The running test cases complete, the module cleanups of the files
+that were started are run and the test cases that were not run are reported
+as skipped.
+
+The limit is shared by the worker processes (created with a
+multiprocessing Manager) and the agents of a distributed run (cancel
+message from the coordinator), the test cases check it before they start.
+"""
+
+import threading
+from types import SimpleNamespace
+
+
+class FailureLimit:
+    def __init__(self, maxfail: int, stopped=None, failures=None, lock=None) -> None:
+        self.maxfail = maxfail
+        # set when the limit is reached (or the run is cancelled)
+        self.stopped = stopped if stopped is not None else threading.Event()
+        # failed test cases, its value is the count
+        self.failures = failures if failures is not None else SimpleNamespace(value=0)
+        self.lock = lock if lock is not None else threading.Lock()
+
+    @classmethod
+    def shared(cls, manager, maxfail: int) -> 'FailureLimit':
+        """
+        Limit shared with the worker processes through the manager
+        """
+        return cls(maxfail, manager.Event(), manager.Value('i', 0), manager.Lock())
+
+    @property
+    def reason(self) -> str:
+        return f"Not run, the run was stopped after {self.maxfail} failed test cases"
+
+    @property
+    def reached(self) -> bool:
+        return self.stopped.is_set()
+
+    @property
+    def count(self) -> int:
+        return self.failures.value
+
+    def add(self, count: int = 1) -> bool:
+        """
+        Count failed test cases, True if this reached the limit
+        """
+        with self.lock:
+            self.failures.value += count
+            if self.maxfail and self.failures.value >= self.maxfail and not self.stopped.is_set():
+                self.stopped.set()
+                return True
+        return False
+
+    def stop(self):
+        self.stopped.set()
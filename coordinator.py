@@ -0,0 +1,290 @@
+"""
+Run the test case files on agents (agent.py), possibly on other hosts
+(run.py --listen). The coordinator hands out the units of work (a test case
+file, the files sharing a SETUP_KEY or a shard of a file) to the agents that
+connect to it, one unit to an agent at a time. The agent runs the unit like a
+parallel worker and sends back
+
+* log - the logs of the unit, as they are written. They are written into the
+  log directory of the run on the coordinator
+* test_case - the result of a test case, as soon as it completes. Written to
+  the report of the run on the coordinator
+* result - the results of the files (and the test cases not sent yet),
+  written to the report of the run on the coordinator
+
+A unit being run by an agent that disconnects (or dies) is given to another
+agent, the results it sent are dropped from the report. The agents report the
+failed test cases as they happen (failures), once --maxfail is reached no new
+unit is given out and the agents running a unit are sent a cancel. The test
+case files must be at the same path on the agents.
+"""
+
+import argparse
+import base64
+import hmac
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+from typing import Dict, List, Set
+
+from protocol import (HELLO_MAX_SIZE, TOKEN_ENV, bound_address, listen, recv_message,
+                      send_message)
+from resources import ResourcePool, merge_resources
+from testcase import TestCaseResult
+from testcase_file import TestCaseFile
+
+
+class Coordinator:
+    def __init__(self, runner, log_dir: str, units: List[List[TestCaseFile]]) -> None:
+        self.runner = runner
+        self.logger = runner.logger
+        self.log_dir = log_dir
+        self.pool = ResourcePool(dict(runner.args.resources))
+        self._condition = threading.Condition()
+        # units waiting for an agent, by id, in the scheduled order
+        self.pending: Dict[int, List[TestCaseFile]] = dict(enumerate(units))
+        # unit id -> (unit, resources) being run by an agent
+        self.running: Dict[int, tuple] = {}
+        # log files written by the current attempt of each unit
+        self.unit_log_files: Dict[int, Set[str]] = {}
+        # (file name, shard) -> names of the test cases sent by the current
+        # attempt of each unit
+        self.unit_test_cases: Dict[int, Dict[tuple, List[str]]] = {}
+        self.agents = 0
+        # lock to send on the connection of each agent, a cancel message is
+        # sent by the thread that saw the failure limit reached
+        self.connections: Dict[socket.socket, threading.Lock] = {}
+        # counts the failures reported by the agents (--maxfail)
+        self.failure_limit = runner.failure_limit
+        self.local_agents: List[subprocess.Popen] = []
+        self.server: socket.socket = None
+        self.address = ""
+        # agents must send it in their hello, a random one (known only to
+        # the local agents) unless it's given in the environment
+        self.token = os.environ.get(TOKEN_ENV) or secrets.token_hex(16)
+        self.token_given = bool(os.environ.get(TOKEN_ENV))
+
+    def _run_message(self, unit_id: int, unit: List[TestCaseFile]) -> Dict:
+        selection = unit[0].selection
+        return {
+            'type': 'run',
+            'unit_id': unit_id,
+            'file_names': [tc_file.file_name for tc_file in unit],
+            'shard': unit[0].shard,
+            'cwd': os.getcwd(),
+            'log_dir': self.log_dir,
+            'args': vars(self.runner.args),
+            # the arguments of the test case files are parsed from it
+            'argv': self.runner.argv,
+            'selection': selection.to_json() if selection else None,
+            'framework_session_setup_output': self.runner.framework_session_setup_output,
+            # the agent stops the unit on its own once the failures so far
+            # and its own reach maxfail
+            'maxfail': self.failure_limit.maxfail if self.failure_limit else None,
+            'failures': self.failure_limit.count if self.failure_limit else 0,
+        }
+
+    def _stopped(self) -> bool:
+        return bool(self.failure_limit and self.failure_limit.reached)
+
+    def _send(self, conn: socket.socket, message: Dict):
+        with self.connections[conn]:
+            send_message(conn, message)
+
+    def _add_failures(self, count: int):
+        # failures of the test cases run by an agent. Every agent running a
+        # unit is asked to stop once the limit is reached
+        if not self.failure_limit or not self.failure_limit.add(count):
+            return
+        self.logger.info(f"Stopping the run, {self.failure_limit.maxfail} test cases failed")
+        with self._condition:
+            for conn in list(self.connections):
+                try:
+                    self._send(conn, {'type': 'cancel'})
+                except OSError:
+                    pass
+            self._condition.notify_all()
+
+    def _next_unit(self):
+        # wait for a unit whose resources are free. None when all the units
+        # are done
+        with self._condition:
+            while (self.pending and not self._stopped()) or self.running:
+                for unit_id, unit in list(self.pending.items()):
+                    if self._stopped():
+                        break
+                    resources = merge_resources(*(tc_file.resources for tc_file in unit))
+                    if self.pool.try_acquire(resources):
+                        del self.pending[unit_id]
+                        self.running[unit_id] = (unit, resources)
+                        self.unit_log_files[unit_id] = set()
+                        self.unit_test_cases[unit_id] = {}
+                        return unit_id, unit
+                self._condition.wait()
+            return None, None
+
+    def _requeue(self, unit_id: int):
+        # the agent is gone, the logs of the unit are removed and the unit is
+        # run again by another agent, before the units that were not started
+        with self._condition:
+            unit, resources = self.running.pop(unit_id)
+            self.pool.release(resources)
+            for path in self.unit_log_files.pop(unit_id, set()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            for (file_name, shard), names in self.unit_test_cases.pop(unit_id, {}).items():
+                self.runner.report_writer.drop_test_cases(file_name, shard, names)
+            self.pending = {unit_id: unit, **self.pending}
+            self._condition.notify_all()
+
+    def _write_log(self, unit_id: int, message: Dict):
+        path = os.path.normpath(message['path'])
+        if os.path.isabs(path) or path.startswith('..'):
+            return
+        path = os.path.join(self.log_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as fd:
+            fd.write(base64.b64decode(message['data']))
+        self.unit_log_files[unit_id].add(path)
+
+    def _add_test_case(self, unit_id: int, message: Dict):
+        tc = TestCaseResult.from_json(message['test_case'])
+        shard = tuple(message['shard']) if message['shard'] else None
+        self.unit_test_cases[unit_id].setdefault((tc.file_name, shard), []).append(tc.name)
+        self.runner.report_writer.add_test_case(tc, shard)
+
+    def _complete(self, unit_id: int, message: Dict):
+        with self._condition:
+            unit, resources = self.running.pop(unit_id)
+            self.pool.release(resources)
+            self.unit_log_files.pop(unit_id, None)
+            self.unit_test_cases.pop(unit_id, None)
+            if message.get('error'):
+                # the test cases of the files are skipped with the error
+                self.logger.info(
+                    f"Agent failed running {', '.join(f.file_name for f in unit)}\n{message['error']}")
+                for tc_file in unit:
+                    tc_file.skip_not_imported(f"Not run, the agent failed\n{message['error']}")
+            else:
+                for tc_file, result in zip(unit, message['results']):
+                    tc_file.set_result({
+                        **result,
+                        'args': argparse.Namespace(**result['args']),
+                        'test_cases': [TestCaseResult.from_json(tc) for tc in result['test_cases']],
+                    })
+            for tc_file in unit:
+                self.runner.report_writer.add_test_case_file(tc_file)
+                self.logger.info(f"Completed running {tc_file.file_name}")
+            self._condition.notify_all()
+
+    def _serve_agent(self, conn: socket.socket):
+        unit_id = None
+        name = "agent"
+        self.connections[conn] = threading.Lock()
+        try:
+            hello = recv_message(conn, HELLO_MAX_SIZE)
+            if not hmac.compare_digest(str(hello.get('token', '')), self.token):
+                peer = conn.getpeername() or 'unix socket'
+                self.logger.info(f"Rejected a connection from {peer}, wrong {TOKEN_ENV}")
+                return
+            name = f"agent {hello.get('host')}/{hello.get('pid')}"
+            self.logger.info(f"Connected {name}")
+            while True:
+                unit_id, unit = self._next_unit()
+                if unit is None:
+                    self._send(conn, {'type': 'exit'})
+                    break
+                for tc_file in unit:
+                    self.logger.info(f"Planning to run {tc_file.file_name} on {name}")
+                self._send(conn, self._run_message(unit_id, unit))
+                while True:
+                    message = recv_message(conn)
+                    if message['type'] == 'log':
+                        self._write_log(unit_id, message)
+                    elif message['type'] == 'test_case':
+                        self._add_test_case(unit_id, message)
+                    elif message['type'] == 'failures':
+                        self._add_failures(message['count'])
+                    elif message['type'] == 'result':
+                        self._complete(unit_id, message)
+                        unit_id = None
+                        break
+        except (OSError, ValueError) as err:
+            # ConnectionError is an OSError
+            self.logger.info(f"Lost {name}: {err}")
+            if unit_id is not None:
+                self.logger.info(f"Running unit {unit_id} of {name} on another agent")
+                self._requeue(unit_id)
+        finally:
+            conn.close()
+            with self._condition:
+                self.connections.pop(conn, None)
+                self.agents -= 1
+                self._condition.notify_all()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                # server closed at the end of the run
+                return
+            with self._condition:
+                self.agents += 1
+            threading.Thread(target=self._serve_agent, args=(conn,),
+                             name='coordinator-agent', daemon=True).start()
+
+    def start_local_agents(self, count: int):
+        """
+        Start agents on this host, e.g. to try the distributed run
+        """
+        agent_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.py')
+        env = {**os.environ, TOKEN_ENV: self.token}
+        for _ in range(count):
+            self.local_agents.append(
+                subprocess.Popen([sys.executable, agent_script, self.address], env=env))
+
+    def _local_agents_gone(self) -> bool:
+        return (bool(self.local_agents) and self.agents == 0 and
+                all(agent.poll() is not None for agent in self.local_agents))
+
+    def run(self, address: str, local_agents: int = 0):
+        self.server = listen(address)
+        self.address = bound_address(self.server)
+        self.logger.info(f"Waiting for agents on {self.address}")
+        if not self.token_given and not local_agents:
+            self.logger.info(f"Set the same {TOKEN_ENV} for the runner and the agents, "
+                             f"agents without it can't connect")
+        threading.Thread(target=self._accept, name='coordinator', daemon=True).start()
+        self.start_local_agents(local_agents)
+        try:
+            with self._condition:
+                while (self.pending and not self._stopped()) or self.running:
+                    # a run with only local agents can't continue once they exit
+                    if self._local_agents_gone():
+                        self.logger.info("All the agents exited")
+                        break
+                    self._condition.wait(1)
+                left = list(self.pending.values())
+                self.pending.clear()
+        finally:
+            self.server.close()
+            if self.address.startswith('unix:'):
+                try:
+                    os.remove(self.address[len('unix:'):])
+                except OSError:
+                    pass
+        for unit in left:
+            if self._stopped():
+                self.runner.skip_stopped_test_case_files(unit)
+                continue
+            for tc_file in unit:
+                self.logger.info(f"Not run {tc_file.file_name}")
+                self.runner.report_writer.add_test_case_file(tc_file)
+        for agent in self.local_agents:
+            agent.wait()
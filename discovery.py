@@ -0,0 +1,217 @@
+"""
+Find the test cases of a test case file without importing it. The file is
+parsed (ast) and the test case functions, their doc strings and the other
+special functions are read from the parse tree, so listing the test cases or
+planning a run does not run the code of the module (and its imports). The
+file is imported only when it's run.
+
+The discovered test cases are cached on the disk (DiscoveryCache), keyed by
+the file path and its modification time/size, with the hash of the content
+to detect a file that was touched but not modified. A file that has not
+changed since the last run costs a stat.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List
+
+# version of what discover_source returns, the cache of a different
+# version is discarded
+CACHE_VERSION = 6
+
+
+def _defines(node: ast.stmt, name: str) -> bool:
+    # function definition, assignment or import of the name at the module level
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return node.name == name
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return any((alias.asname or alias.name) == name for alias in node.names)
+    if isinstance(node, ast.Assign):
+        return any(isinstance(target, ast.Name) and target.id == name
+                   for target in node.targets)
+    return False
+
+
+def _creates_test_cases(node: ast.stmt) -> bool:
+    # module level statement that may bind test_* names the parse tree does
+    # not show as test case functions: star or test_* imports, assignments to
+    # test_* names or globals() and functions defined in an if/for/try block
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return any(alias.name == '*' or (alias.asname or alias.name).startswith('test_')
+                   for alias in node.names)
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return False
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+            if child.id.startswith('test_'):
+                return True
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if child.name.startswith('test_'):
+                return True
+        elif isinstance(child, ast.Call) and isinstance(child.func, ast.Name):
+            if child.func.id == 'globals':
+                return True
+    return False
+
+
+def _decorator_calls(node: ast.FunctionDef, name: str) -> List[ast.Call]:
+    # @name(...) (or @module.name(...)) decorators of the function, in the
+    # order they are applied (bottom up)
+    calls = []
+    for decorator in reversed(node.decorator_list):
+        if not isinstance(decorator, ast.Call):
+            continue
+        func = decorator.func
+        if (func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)) == name:
+            calls.append(decorator)
+    return calls
+
+
+def _tags(node: ast.FunctionDef) -> List[str]:
+    # tags given with the @tags(...) decorator
+    tags = []
+    for decorator in _decorator_calls(node, 'tags'):
+        tags.extend(arg.value for arg in decorator.args
+                    if isinstance(arg, ast.Constant) and isinstance(arg.value, str))
+    return sorted(set(tags))
+
+
+def _resources(node: ast.FunctionDef) -> List[str]:
+    # resources given with the @resources(...) decorator, None if they are
+    # not literals (known only when the file is imported)
+    names = []
+    for decorator in _decorator_calls(node, 'resources'):
+        for arg in decorator.args:
+            if not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)):
+                return None
+            names.append(arg.value)
+    return names
+
+
+def _params(node: ast.FunctionDef) -> Dict:
+    # values given with the @parametrize(name=[...]) decorator, {} if the
+    # function is not parametrized and None if the values are not literals
+    # (known only when the file is imported)
+    params = {}
+    for decorator in _decorator_calls(node, 'parametrize'):
+        for keyword in decorator.keywords:
+            if keyword.arg is None:
+                return None
+            try:
+                params[keyword.arg] = list(ast.literal_eval(keyword.value))
+            except (ValueError, TypeError, SyntaxError):
+                return None
+    return params
+
+
+def discover_file(file_name: str) -> Dict:
+    """
+    Parse the test case file and return its test case functions (name,
+    description, tags, resources and parametrize values, sorted by name like
+    inspect.getmembers), whether it defines parse_args, the literal values of
+    its upper case variables, the names of the ones that are not literals and
+    whether the module may create test case functions that are not in the
+    source (dynamic_test_cases), they are known only when it's imported
+    """
+    with open(file_name, 'rb') as fd:
+        return discover_source(fd.read(), file_name)
+
+
+def discover_source(source: bytes, file_name: str) -> Dict:
+    tree = ast.parse(source, filename=file_name)
+    test_cases: Dict[str, Dict] = {}
+    parse_args = False
+    constants: Dict = {}
+    dynamic = set()
+    dynamic_test_cases = False
+    for node in tree.body:
+        if _creates_test_cases(node):
+            dynamic_test_cases = True
+        if _defines(node, 'parse_args'):
+            parse_args = True
+        if isinstance(node, ast.Assign):
+            # module settings like SETUP_KEY, CONCURRENCY. Only the literal
+            # values can be read without running the module
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id.isupper():
+                    try:
+                        constants[target.id] = ast.literal_eval(node.value)
+                        dynamic.discard(target.id)
+                    except (ValueError, TypeError):
+                        constants.pop(target.id, None)
+                        dynamic.add(target.id)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name.startswith('test_'):
+            # a function defined again replaces the earlier one
+            test_cases[node.name] = {
+                'name': node.name,
+                'description': ast.get_docstring(node),
+                'tags': _tags(node),
+                'resources': _resources(node),
+                'params': _params(node),
+            }
+    return {
+        'test_cases': [test_cases[name] for name in sorted(test_cases)],
+        'parse_args': parse_args,
+        'constants': constants,
+        'dynamic_constants': sorted(dynamic),
+        'dynamic_test_cases': dynamic_test_cases,
+    }
+
+
+class DiscoveryCache:
+    def __init__(self, cache_file: str) -> None:
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._dirty = False
+        # file path -> {mtime, size, hash, discovered}
+        self._entries: Dict[str, Dict] = {}
+        try:
+            with open(cache_file) as fd:
+                data = json.load(fd)
+            if data['version'] == CACHE_VERSION:
+                self._entries = data['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            # no cache yet or a corrupt one, start afresh
+            pass
+
+    def discover(self, file_name: str) -> Dict:
+        """
+        Discovered test cases of the file (see discover_file), from the
+        cache if the file has not changed
+        """
+        stat = os.stat(file_name)
+        with self._lock:
+            entry = self._entries.get(file_name)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry['discovered']
+        with open(file_name, 'rb') as fd:
+            source = fd.read()
+        content_hash = hashlib.sha1(source).hexdigest()
+        if not entry or entry['hash'] != content_hash:
+            entry = {'hash': content_hash,
+                     'discovered': discover_source(source, file_name)}
+        entry['mtime'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        with self._lock:
+            self._entries[file_name] = entry
+            self._dirty = True
+        return entry['discovered']
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+                tmp_file = f"{self.cache_file}.{os.getpid()}"
+                with open(tmp_file, 'w') as fd:
+                    json.dump({'version': CACHE_VERSION, 'files': self._entries}, fd)
+                os.replace(tmp_file, self.cache_file)
+                self._dirty = False
+            except OSError:
+                # cache is only an optimization, a read only logs directory
+                # should not fail the run
+                pass
@@ -0,0 +1,367 @@
+"""
+Log files of the test cases. Every test case (and the setup/cleanup functions
+run as test cases) logs into its own file in the log directory. The log
+manager owns the loggers and the file handlers of these files: a log file
+gets one logger/handler however many times it is asked for, the handler is
+closed when the test case is done with it, and the number of files kept open
+at the same time is bounded.
+
+Optionally (--async-log) the records are written by a background writer
+thread: the loggers only put the records into a queue and the writer passes
+them on to the file (or stream) handlers, flushing once per batch of records.
+
+The log files can be gzip compressed (--compress-logs, the file name ends
+with .gz) and capped in size (--log-max-size). A capped file keeps the first
+half of the limit as it's written and the last half in memory, written with
+a line saying how much was dropped in between when the file is closed. See
+log_reader.py to read them.
+"""
+
+import atexit
+import collections
+import gzip
+import logging
+import logging.handlers
+import queue
+import threading
+from typing import Callable, Dict
+
+
+class CaseFileHandler(logging.FileHandler):
+    """
+    FileHandler that opens its file only when there is a record to write.
+    The file can be closed to free the descriptor and it is opened again
+    (in append mode) on the next record
+    """
+
+    def __init__(self, file_name: str, on_open: Callable = None, compress: bool = False,
+                 max_bytes: int = None):
+        self.compress = compress
+        super().__init__(file_name, mode='a', delay=True)
+        self.on_open = on_open
+        # set when the records are written by the LogWriter, which flushes
+        # the stream once per batch of records instead of after every record
+        self.buffered = False
+        # size limit of the file, the bytes written at the head of the file
+        # and the records kept for its tail
+        self.max_bytes = max_bytes
+        self.head_bytes = 0
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.dropped_bytes = 0
+
+    def _open(self):
+        if self.compress:
+            # a file closed to free the descriptor gets another gzip member
+            # when it's opened again, readers see one stream
+            return gzip.open(self.baseFilename, 'at', compresslevel=6,
+                             encoding=self.encoding, errors=self.errors)
+        return super()._open()
+
+    def emit(self, record: logging.LogRecord):
+        if self.stream is None and self.on_open:
+            self.on_open(self)
+        if self.max_bytes is None:
+            super().emit(record)
+            return
+        try:
+            msg = self.format(record) + self.terminator
+        except Exception:
+            self.handleError(record)
+            return
+        size = len(msg.encode('utf-8', 'replace'))
+        if not self.tail and self.head_bytes + size <= self.max_bytes // 2:
+            self.head_bytes += size
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            self.flush()
+            return
+        self.tail.append((msg, size))
+        self.tail_bytes += size
+        while self.tail_bytes > self.max_bytes - self.max_bytes // 2 and len(self.tail) > 1:
+            _, dropped = self.tail.popleft()
+            self.tail_bytes -= dropped
+            self.dropped_bytes += dropped
+
+    def _write_tail(self):
+        if not self.tail:
+            return
+        if self.stream is None:
+            if self.on_open:
+                self.on_open(self)
+            self.stream = self._open()
+        if self.dropped_bytes:
+            self.stream.write(f"... {self.dropped_bytes} bytes dropped, "
+                              f"the log is limited to {self.max_bytes} bytes ...{self.terminator}")
+        self.stream.write(''.join(msg for msg, _ in self.tail))
+        self.tail.clear()
+
+    def close(self):
+        with self.lock:
+            self._write_tail()
+            super().close()
+
+    def flush(self):
+        # a compressed file is flushed when it's closed, flushing after
+        # every record (or batch) makes the compression poor
+        if not self.buffered and not self.compress:
+            super().flush()
+
+    def flush_batch(self):
+        if not self.compress:
+            super().flush()
+
+    def close_stream(self):
+        # a forked process writes into the same file, each process writes a
+        # stream (gzip member) of its own. Opened again on the next record
+        with self.lock:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+
+    def get_state(self) -> tuple:
+        # what's kept of the records written so far (--log-max-size), the
+        # state moves between the processes writing into the file
+        return self.head_bytes, list(self.tail), self.tail_bytes, self.dropped_bytes
+
+    def set_state(self, state: tuple):
+        with self.lock:
+            self.head_bytes, tail, self.tail_bytes, self.dropped_bytes = state
+            self.tail = collections.deque(tail)
+
+    def try_close_stream(self) -> bool:
+        # dont wait for a handler that is in the middle of writing a record,
+        # the caller picks another one to close
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.lock.release()
+        return True
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread that writes the queued records. Besides the records the
+    queue carries the commands from the LogManager: a threading.Event to set
+    once everything queued before it is written, a (logger name, handler)
+    tuple to close the handler and None to stop the writer
+    """
+
+    def __init__(self, manager: 'LogManager', batch_size: int = 1000) -> None:
+        super().__init__(name='log-writer', daemon=True)
+        self.manager = manager
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = set()
+            events = []
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                elif isinstance(item, tuple):
+                    self.manager._close_handler(*item)
+                    written.discard(item[1])
+                else:
+                    handler = self.manager._targets.get(item.name)
+                    if handler:
+                        handler.handle(item)
+                        written.add(handler)
+            for handler in written:
+                if isinstance(handler, CaseFileHandler):
+                    handler.flush_batch()
+            for event in events:
+                event.set()
+
+
+class LogManager:
+    def __init__(self, max_open_files: int = 64) -> None:
+        self.max_open_files = max_open_files
+        # gzip the log files (--compress-logs) and limit the size of each
+        # (--log-max-size bytes), set before the loggers are created
+        self.compress = False
+        self.max_bytes: int = None
+        self.formatter = logging.Formatter(
+            "%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s",
+            datefmt="%Y-%m-%d-%H:%M:%S")
+        self._lock = threading.Lock()
+        self._loggers: Dict[str, logging.Logger] = {}
+        # number of test cases using the log file
+        self._refs: Dict[str, int] = collections.defaultdict(int)
+        # handlers that have their file open, in the order they were opened
+        self._open_handlers = collections.OrderedDict()
+        # background writer, handler of the records written by the writer
+        # (by the logger name) and the handler putting the records in its queue
+        self._writer: LogWriter = None
+        self._targets: Dict[str, logging.Handler] = {}
+        self._queue_handler: logging.handlers.QueueHandler = None
+
+    def start_writer(self):
+        """
+        Write the records of the loggers created from now on in a background
+        thread. A forked process gets a writer (and a queue) of its own
+        """
+        with self._lock:
+            if self._writer and self._writer.is_alive():
+                return
+            if not self._queue_handler:
+                atexit.register(self.stop)
+                self._queue_handler = logging.handlers.QueueHandler(None)
+                self._queue_handler.setLevel(logging.DEBUG)
+            self._writer = LogWriter(self)
+            self._queue_handler.queue = self._writer.queue
+            self._writer.start()
+
+    def after_fork(self):
+        """
+        Called in a forked process. The writer thread of the parent is not
+        copied into the process, start a new one if it was running
+        """
+        self._lock = threading.Lock()
+        if self._writer:
+            self.start_writer()
+
+    def flush(self):
+        """
+        Wait until all the records logged so far are written
+        """
+        if self._writer and self._writer.is_alive():
+            event = threading.Event()
+            self._writer.queue.put(event)
+            event.wait()
+
+    def stop(self):
+        if self._writer and self._writer.is_alive():
+            self._writer.queue.put(None)
+            self._writer.join()
+
+    def log_file_name(self, file_name: str) -> str:
+        """
+        Name of the log file written for file_name, .gz added when compressed
+        """
+        return file_name + '.gz' if self.compress else file_name
+
+    def file_handler(self, log_file: str) -> CaseFileHandler:
+        """
+        Handler writing into log_file, None if the file has no logger
+        """
+        with self._lock:
+            if log_file in self._targets:
+                return self._targets[log_file]
+            logger = self._loggers.get(log_file)
+        for handler in (logger.handlers if logger else []):
+            if isinstance(handler, CaseFileHandler):
+                return handler
+        return None
+
+    def get_logger(self, log_file: str) -> logging.Logger:
+        """
+        Return the logger writing into log_file. The logger is created on the
+        first call and the same one is returned until it is released
+        """
+        with self._lock:
+            self._refs[log_file] += 1
+            logger = self._loggers.get(log_file)
+            if logger:
+                return logger
+            # the logger is not created with logging.getLogger, so the loggers
+            # of the finished test cases are not held by the logging module
+            logger = logging.Logger(log_file, logging.DEBUG)
+            logger.propagate = False
+            self._add_handler(logger, self._create_handler(log_file))
+            self._loggers[log_file] = logger
+            return logger
+
+    def _create_handler(self, log_file: str) -> logging.Handler:
+        handler = CaseFileHandler(log_file, on_open=self._opening, compress=self.compress,
+                                  max_bytes=self.max_bytes)
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(self.formatter)
+        return handler
+
+    def add_handler(self, logger: logging.Logger, handler: logging.Handler):
+        """
+        Add the handler to the logger, through the background writer if it
+        is running
+        """
+        with self._lock:
+            self._add_handler(logger, handler)
+
+    def _add_handler(self, logger: logging.Logger, handler: logging.Handler):
+        if not self._writer:
+            logger.addHandler(handler)
+            return
+        if isinstance(handler, CaseFileHandler):
+            handler.buffered = True
+        self._targets[logger.name] = handler
+        if self._queue_handler not in logger.handlers:
+            logger.addHandler(self._queue_handler)
+
+    def _opening(self, handler: CaseFileHandler):
+        # called by the handler before it opens its file. Close the files of
+        # the handlers opened earliest to keep the open files under the limit
+        with self._lock:
+            self._open_handlers[handler] = None
+            self._open_handlers.move_to_end(handler)
+            excess = len(self._open_handlers) - self.max_open_files
+            for other in list(self._open_handlers):
+                if excess <= 0:
+                    break
+                if other is not handler and other.try_close_stream():
+                    del self._open_handlers[other]
+                    excess -= 1
+
+    def release(self, log_file: str):
+        """
+        Test case is done with the log file. Close the handler once all the
+        test cases using the file have released it
+        """
+        with self._lock:
+            self._refs[log_file] -= 1
+            if self._refs[log_file] > 0:
+                return
+            del self._refs[log_file]
+            logger = self._loggers.pop(log_file, None)
+            if not logger:
+                return
+            handlers = list(logger.handlers)
+            for handler in handlers:
+                logger.removeHandler(handler)
+            if self._writer:
+                # the writer closes the handler after writing the records
+                # queued before this
+                self._writer.queue.put((log_file, self._targets[log_file]))
+                return
+        for handler in handlers:
+            self._close_handler(log_file, handler)
+
+    def _close_handler(self, name: str, handler: logging.Handler):
+        with self._lock:
+            self._open_handlers.pop(handler, None)
+            if self._targets.get(name) is handler:
+                del self._targets[name]
+        # close outside the lock, closing waits for the handler's own lock
+        handler.close()
+
+    def close_all(self):
+        for log_file in list(self._loggers):
+            self._refs[log_file] = 1
+            self.release(log_file)
+
+
+log_manager = LogManager()
@@ -0,0 +1,59 @@
+"""
+Print the log files of the test cases, compressed (--compress-logs, .gz) or
+not. A directory prints all the log files under it.
+
+    python log_reader.py logs/latest/feature1/test_case1.gz
+    python log_reader.py logs/latest/feature1 --tail 20
+"""
+
+import argparse
+import collections
+import gzip
+import os
+import sys
+from typing import IO, Iterator, List
+
+
+def open_log(file_name: str) -> IO[str]:
+    """
+    Open the log file for reading text, decompressed if it's gzip
+    """
+    with open(file_name, 'rb') as fd:
+        compressed = fd.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(file_name, 'rt', errors='replace')
+    return open(file_name, errors='replace')
+
+
+def log_files(paths: List[str]) -> Iterator[str]:
+    # the files of a directory, skipping the report and the profiles
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dir_name, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.startswith('report.') or file_name.endswith(('.prof', '.txt')):
+                    continue
+                yield os.path.join(dir_name, file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the test case log files")
+    parser.add_argument('paths', nargs='+', help='Log files or directories')
+    parser.add_argument('-n', '--tail', type=int, metavar='N',
+                        help='Print only the last N lines of every file')
+    args = parser.parse_args()
+    files = list(log_files(args.paths))
+    for file_name in files:
+        if len(files) > 1:
+            print(f"==> {file_name} <==")
+        with open_log(file_name) as fd:
+            lines = collections.deque(fd, maxlen=args.tail) if args.tail else fd
+            for line in lines:
+                sys.stdout.write(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Live progress of a run for monitoring (--metrics-port). A http server, run in
+a background thread, serves the counters of the run in the prometheus text
+format on /metrics
+
+* taurus_test_cases - test cases to run
+* taurus_test_cases_done - test cases done, by status
+* taurus_test_case_files / taurus_test_case_files_done
+* taurus_running_test_case - test case being run, by worker
+* taurus_eta_seconds - expected time to complete the run, from the
+  durations of the earlier runs
+* taurus_phase_duration_seconds - histogram of the time of every phase of
+  the test cases and the module setup/cleanup functions
+
+The counters are read from the ReportStats updated by the ReportWriter, the
+same ones the report is built from at the end of the run.
+"""
+
+import http.server
+import threading
+from typing import Dict, List, Mapping
+
+from report import PHASE_BUCKETS, ReportStats
+from scheduler import predict_run_time
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsServer:
+    def __init__(self, port: int, stats: ReportStats, test_case_files: List[str],
+                 test_cases: int, workers: int = 1, expected_durations: Dict[str, float] = None,
+                 running_test_cases: Mapping[str, str] = None, host: str = '127.0.0.1') -> None:
+        self.stats = stats
+        self.test_case_files = test_case_files
+        self.test_cases = test_cases
+        self.workers = workers
+        # expected duration of the test case files, by file name
+        self.expected_durations = expected_durations or {}
+        # worker -> full name of the test case it's running
+        self.running_test_cases = running_test_cases if running_test_cases is not None else {}
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # requests are not logged into the runner's output
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name='metrics-server', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def eta(self) -> float:
+        """
+        Expected time (secs) for the files that have not completed, None
+        without the durations of the earlier runs
+        """
+        if not self.expected_durations:
+            return None
+        remaining = [duration for file_name, duration in self.expected_durations.items()
+                     if file_name not in self.stats.completed_files]
+        return predict_run_time(remaining, self.workers)
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.stats.lock:
+            stats = self.stats
+            metric('taurus_test_cases', 'gauge', 'Test cases to run', [({}, self.test_cases)])
+            metric('taurus_test_cases_done', 'counter', 'Test cases done by status', [
+                ({'status': 'passed'}, stats.passed),
+                ({'status': 'failed'}, stats.failed),
+                ({'status': 'skipped'}, stats.skipped),
+                ({'status': 'timeout'}, stats.timeout),
+                ({'status': 'flaky'}, stats.flaky),
+                ({'status': 'quarantined'}, stats.quarantined),
+            ])
+            metric('taurus_test_case_files', 'gauge', 'Test case files to run',
+                   [({}, len(self.test_case_files))])
+            metric('taurus_test_case_files_done', 'counter', 'Test case files done',
+                   [({}, len(stats.completed_files))])
+            eta = self.eta()
+            if eta is not None:
+                metric('taurus_eta_seconds', 'gauge',
+                       'Expected time to complete the run, from the earlier runs', [({}, round(eta, 3))])
+            lines.append("# HELP taurus_phase_duration_seconds Time of the test case phases and module hooks")
+            lines.append("# TYPE taurus_phase_duration_seconds histogram")
+            for phase, phase_stats in sorted(stats.phases.items()):
+                cumulative = 0
+                for bound, count in zip(PHASE_BUCKETS, phase_stats['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'taurus_phase_duration_seconds_bucket{{phase="{_label(phase)}",le="{le}"}} {cumulative}')
+                lines.append(f'taurus_phase_duration_seconds_sum{{phase="{_label(phase)}"}} {round(phase_stats["total"], 6)}')
+                lines.append(f'taurus_phase_duration_seconds_count{{phase="{_label(phase)}"}} {phase_stats["count"]}')
+        running = sorted(dict(self.running_test_cases.items()).items())
+        metric('taurus_running_test_case', 'gauge', 'Test case being run by each worker',
+               [({'worker': worker, 'test_case': name}, 1) for worker, name in running])
+        return '\n'.join(lines) + '\n'
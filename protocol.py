@@ -0,0 +1,90 @@
+"""
+Messages between the coordinator (run.py --listen) and the agents (agent.py).
+A message is a json object sent as its length (4 bytes, big endian) followed
+by the utf-8 encoded json. The address is host:port for tcp or unix:path for
+a unix socket
+
+Anyone who can connect is sent the output of framework_session_setup and can
+write logs and results into the run, so an agent has to send the token of
+the run (TOKEN_ENV in the environment of the coordinator and the agents) in
+its hello, the coordinator drops a connection with a wrong token.
+"""
+
+import json
+import os
+import socket
+import struct
+from typing import Dict
+
+_LENGTH = struct.Struct('>I')
+# environment variable with the token shared by the coordinator and its agents
+TOKEN_ENV = 'TAURUS_AGENT_TOKEN'
+# size limit of the hello, read before the agent is known
+HELLO_MAX_SIZE = 1 << 16
+
+
+def _socket_address(address: str):
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def listen(address: str) -> socket.socket:
+    family, sock_address = _socket_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sock_address)
+    if family == socket.AF_UNIX:
+        # only the user running the coordinator can connect
+        os.chmod(sock_address, 0o600)
+    sock.listen()
+    return sock
+
+
+def connect(address: str) -> socket.socket:
+    family, sock_address = _socket_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(sock_address)
+    return sock
+
+
+def bound_address(sock: socket.socket) -> str:
+    """
+    Address to connect to the listening socket, with the port picked by
+    the system for port 0
+    """
+    if sock.family == socket.AF_UNIX:
+        return f"unix:{sock.getsockname()}"
+    host, port = sock.getsockname()[:2]
+    if host == '0.0.0.0':
+        host = '127.0.0.1'
+    return f"{host}:{port}"
+
+
+def send_message(sock: socket.socket, message: Dict):
+    data = json.dumps(message, default=str).encode()
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock: socket.socket, max_size: int = None) -> Dict:
+    """
+    Next message, raises ConnectionError if the other end is gone and
+    ValueError if the message is larger than max_size
+    """
+    size, = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    if max_size is not None and size > max_size:
+        raise ValueError(f"Message of {size} bytes, more than {max_size}")
+    return json.loads(_recv_exactly(sock, size))
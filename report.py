@@ -1,84 +1,483 @@
+import bisect
 import datetime
+import heapq
+import inspect
+import io
 import json
 import os
-from typing import List
+import pstats
+import queue
+import sys
+import tempfile
+import textwrap
+import threading
+from typing import IO, Dict, Iterator, List, Set, Tuple
 
 from tabulate import tabulate
 
-from testcase import TestCase
+from testcase import TestCase, TestCaseResult
 from testcase_file import TestCaseFile
 
 
-def test_case_to_json(o: TestCase):
-    return o.to_json()
+STREAM_FILE_NAME = 'report.jsonl'
+# number of the slowest phases/hooks listed in the report
+SLOWEST_COUNT = 10
+# upper bounds (secs) of the buckets of the phase time histograms, the last
+# bucket has the longer ones
+PHASE_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, float('inf'))
 
 
-class Report:
-    def __init__(self, test_case_files: List[TestCaseFile], log_dir: str):
-        self.test_case_files: List[TestCaseFile] = test_case_files
-        self.log_dir = log_dir
+def parse_time(value: str) -> datetime.datetime:
+    # times are stored as str(datetime), "None" if the time was not set
+    if not value or value == "None":
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
+def _read_records(stream_file: str) -> Iterator[Dict]:
+    with open(stream_file) as fd:
+        for line in fd:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # last line of a run that crashed while writing it
+                continue
+
+
+def read_stream(log_dir: str) -> Iterator[Dict]:
+    """
+    Read the records written by the ReportWriter into the log directory. The
+    results of a unit that was run again (its agent was lost) are dropped by
+    a dropped record, only the results written after it are kept
+    """
+    stream_file = os.path.join(log_dir, STREAM_FILE_NAME)
+    if not os.path.exists(stream_file):
+        return
+    # (file name, test case name) -> position of the last dropped record
+    # naming it. Runs without one read the file once
+    dropped: Dict[tuple, int] = {}
+    with open(stream_file) as fd:
+        if any('"record": "dropped"' in line for line in fd):
+            for idx, record in enumerate(_read_records(stream_file)):
+                if record['record'] == 'dropped':
+                    for name in record['names']:
+                        dropped[(record['file_name'], name)] = idx
+    for idx, record in enumerate(_read_records(stream_file)):
+        if record['record'] == 'dropped':
+            continue
+        if record['record'] == 'test_case' and \
+                dropped.get((record['file_name'], record['name']), -1) > idx:
+            continue
+        yield record
+
+
+def read_test_case_results(log_dir: str) -> Iterator[Dict]:
+    """
+    Results (to_json) of the test cases of a previous run, from its
+    report.json or, if the run did not complete, from its report.jsonl
+    """
+    json_file_name = os.path.join(log_dir, 'report.json')
+    if os.path.exists(json_file_name):
+        with open(json_file_name) as fd:
+            data = json.load(fd)
+        for tc_file in data['test_case_files']:
+            yield from tc_file['test_cases']
+        return
+    for record in read_stream(log_dir):
+        if record.pop('record') == 'test_case':
+            yield record
+
+
+def write_profile_summary(log_dir: str, top: int) -> str:
+    """
+    Combine the profiles of the test cases of the run (--profile) and write
+    the top functions by their own time into profile.txt. Returns the text
+    """
+    profile_files = [record['profile_file'] for record in read_stream(log_dir)
+                     if record['record'] == 'test_case' and record.get('profile_file') and
+                     os.path.exists(record['profile_file'])]
+    if not profile_files:
+        return ""
+    output = io.StringIO()
+    stats = pstats.Stats(*profile_files, stream=output)
+    output.write(f"Profiles of {len(profile_files)} test cases\n")
+    stats.sort_stats('tottime').print_stats(top)
+    with open(os.path.join(log_dir, 'profile.txt'), 'w') as fd:
+        fd.write(output.getvalue())
+    return output.getvalue()
+
+
+class ReportStats:
+    """
+    Counts and times of the test case records of a run, updated as the
+    records are added. Built by the Report from report.jsonl at the end of the
+    run, and by the ReportWriter while the run is in progress (live metrics)
+    """
+
+    def __init__(self, mem_threshold: float = None) -> None:
+        # test cases/hooks that grew the RSS by more than this (MB) are listed
+        self.mem_threshold = mem_threshold
+        self.lock = threading.Lock()
         self.start_time: datetime.datetime = None
         self.end_time: datetime.datetime = None
-        self.duration:int = 0
+        self.duration: int = 0
         self.total: int = 0
         self.passed: int = 0
         self.failed: int = 0
         self.skipped: int = 0
-        self.failed_test_cases: List[TestCase] = []
+        self.timeout: int = 0
+        # passed on a rerun (--reruns), failed but quarantined (--quarantine)
+        self.flaky: int = 0
+        self.quarantined: int = 0
+        # (full_name, error) of the failed/skipped test cases
+        self.failed_test_cases: List = []
+        # (full_name, runs) of the flaky ones, (full_name, error) of the
+        # quarantined ones
+        self.flaky_test_cases: List = []
+        self.quarantined_test_cases: List = []
+        # names of the test case files that completed
+        self.completed_files: Set[str] = set()
+        # count, total and max time and the histogram (PHASE_BUCKETS) of every
+        # phase of the test cases and every module hook, by name
+        self.phases: Dict[str, Dict] = {}
+        # (time, name, phase) of the slowest phases/hooks, a heap
+        self.slowest: List = []
+        # (name, phase, rss growth kB) of the test cases/hooks over mem_threshold
+        self.memory_growth: List = []
+
+    def add(self, record: Dict):
+        with self.lock:
+            self._add(record)
+
+    def _add(self, record: Dict):
+        # the start and end times are the earliest and the latest of all the
+        # records. Files run in parallel do not finish in order, and a file
+        # skipped due to a failed setup does not have an end time
+        start_time = parse_time(record['start_time'])
+        end_time = parse_time(record['end_time'])
+        if start_time and (not self.start_time or start_time < self.start_time):
+            self.start_time = start_time
+        if end_time and (not self.end_time or end_time > self.end_time):
+            self.end_time = end_time
+        if self.start_time and self.end_time:
+            self.duration = (self.end_time - self.start_time).total_seconds()
+        if record['record'] != 'test_case':
+            self.completed_files.add(record['file_name'])
+            module_name = inspect.getmodulename(record['file_name'])
+            for hook, secs in record.get('hooks', {}).items():
+                self._add_phase(module_name, hook, secs)
+            for hook, usage in record.get('hook_usage', {}).items():
+                self._check_memory(module_name, hook, usage)
+            return
+        for phase, secs in record.get('phases', {}).items():
+            self._add_phase(record['full_name'], phase, secs)
+        self._check_memory(record['full_name'], 'test_case', record.get('usage'))
+        self.total += 1
+        if record['status'] == "passed":
+            self.passed += 1
+        elif record['status'] == "flaky":
+            self.flaky += 1
+            self.flaky_test_cases.append((record['full_name'], len(record.get('attempts') or [])))
+        elif record.get('quarantined'):
+            self.quarantined += 1
+            self.quarantined_test_cases.append((record['full_name'], record['error']))
+        elif record['status'] == "":
+            self.skipped += 1
+            # why it was not run, if known (e.g. --maxfail)
+            self.failed_test_cases.append((record['full_name'], record['error']))
+        elif record['status'] == "timeout":
+            self.timeout += 1
+            self.failed_test_cases.append(
+                (record['full_name'], record['error']))
+        else:
+            self.failed += 1
+            self.failed_test_cases.append(
+                (record['full_name'], record['error']))
+
+    def _add_phase(self, name: str, phase: str, secs: float):
+        stats = self.phases.setdefault(phase, {'count': 0, 'total': 0.0, 'max': 0.0,
+                                               'buckets': [0] * len(PHASE_BUCKETS)})
+        stats['count'] += 1
+        stats['total'] += secs
+        stats['max'] = max(stats['max'], secs)
+        stats['buckets'][bisect.bisect_left(PHASE_BUCKETS, secs)] += 1
+        heapq.heappush(self.slowest, (secs, name, phase))
+        if len(self.slowest) > SLOWEST_COUNT:
+            heapq.heappop(self.slowest)
+
+    def _check_memory(self, name: str, phase: str, usage: Dict):
+        if self.mem_threshold is None or not usage or usage.get('rss_kb') is None:
+            return
+        if usage['rss_kb'] > self.mem_threshold * 1024:
+            self.memory_growth.append((name, phase, usage['rss_kb']))
+
+    def phase_summary(self) -> Dict:
+        """
+        Time of each phase/hook, the largest total first, and the slowest
+        phases/hooks of the run
+        """
+        phases = {}
+        for phase, stats in sorted(self.phases.items(), key=lambda item: -item[1]['total']):
+            phases[phase] = {
+                'count': stats['count'],
+                'total': round(stats['total'], 6),
+                'mean': round(stats['total'] / stats['count'], 6),
+                'max': round(stats['max'], 6),
+            }
+        slowest = [{'name': name, 'phase': phase, 'duration': round(secs, 6)}
+                   for secs, name, phase in sorted(self.slowest, reverse=True)]
+        return {'phases': phases, 'slowest': slowest}
+
+
+class ReportWriter:
+    """
+    Write a json line into report.jsonl for every test case as soon as it is
+    done and for every test case file at the end of the file. The report is
+    built from these lines, so the results of the completed test cases are
+    available even if the run does not complete
+    """
+
+    def __init__(self, log_dir: str, stats: ReportStats = None) -> None:
+        self.file_name = os.path.join(log_dir, STREAM_FILE_NAME)
+        self._fd = open(self.file_name, 'w')
+        self._lock = threading.Lock()
+        # live stats of the run, updated with every record
+        self.stats = stats
+        # names of the test cases written so far, by test case file
+        self._written: Dict[str, set] = {}
+
+    def _write(self, record: Dict):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._fd.write(line + '\n')
+            self._fd.flush()
+        if self.stats:
+            self.stats.add(record)
+
+    def add_test_case(self, tc: TestCase, shard: tuple = None):
+        # the test cases of a shard (of a file with SHARDS) are grouped under
+        # the shard in the report
+        shard = tuple(shard) if shard else None
+        record = {'record': 'test_case', **tc.to_json()}
+        # the args are the same for all the test cases of a file, they are
+        # written once with the file
+        del record['args']
+        if shard:
+            record['shard'] = list(shard)
+        self._write(record)
+        with self._lock:
+            self._written.setdefault((tc.file_name, shard), set()).add(tc.name)
+
+    def drop_test_cases(self, file_name: str, shard: tuple, names: List[str]):
+        """
+        Results written for a unit that is run again (its agent was lost),
+        the report keeps the ones written after this
+        """
+        shard = tuple(shard) if shard else None
+        line = json.dumps({'record': 'dropped', 'file_name': file_name, 'names': names})
+        with self._lock:
+            self._written.get((file_name, shard), set()).difference_update(names)
+            self._fd.write(line + '\n')
+            self._fd.flush()
+
+    def add_queued_test_cases(self, results: queue.Queue):
+        """
+        Write the results sent by the worker processes so far (see
+        QueueReportWriter)
+        """
+        while True:
+            try:
+                data = results.get_nowait()
+            except queue.Empty:
+                return
+            shard = data.pop('shard')
+            self.add_test_case(TestCaseResult.from_json(data), shard)
+
+    def add_test_case_file(self, tc_file: TestCaseFile):
+        # test cases that were not run (and written) are written here,
+        # followed by the file itself. The file then drops its results
+        key = (tc_file.file_name, tc_file.shard)
+        with self._lock:
+            written = self._written.pop(key, set())
+        for tc in tc_file.iter_test_cases():
+            if tc.name not in written:
+                self.add_test_case(tc, tc_file.shard)
+        with self._lock:
+            self._written.pop(key, None)
+        self._write({'record': 'test_case_file', **tc_file.to_json()})
+        # the results are in the report from here on
+        tc_file.release()
+
+    def close(self):
+        self._fd.close()
+
+
+class QueueReportWriter:
+    """
+    Report writer of a worker process (or an agent), the result of every
+    test case is put in the queue as soon as the test case completes. The
+    runner writes them with ReportWriter.add_queued_test_cases
+    """
+
+    def __init__(self, results: queue.Queue) -> None:
+        self.results = results
+
+    def add_test_case(self, tc: TestCase, shard: tuple = None):
+        data = tc.to_json()
+        del data['args']
+        self.results.put({**data, 'shard': shard})
+
+
+class Report(ReportStats):
+    def __init__(self, log_dir: str, mem_threshold: float = None):
+        super().__init__(mem_threshold)
+        self.log_dir = log_dir
         self.generate_stats()
         self.generate_json_report()
         self.generate_summary()
 
     def generate_stats(self):
-        # get the start and end time from the first and the last file
-        self.start_time = self.test_case_files[0].start_time
-        self.end_time = self.test_case_files[-1].end_time
-        if self.end_time:
-            self.duration = (self.end_time - self.start_time).total_seconds()
-        for tc_file in self.test_case_files:
-            for tc in tc_file.get_test_cases():
-                self.total += 1
-                if tc.status == "passed":
-                    self.passed += 1
-                elif tc.status == "":
-                    self.skipped += 1
-                    self.failed_test_cases.append(tc)
-                else:
-                    self.failed += 1
-                    self.failed_test_cases.append(tc)
+        for record in read_stream(self.log_dir):
+            self.add(record)
+
+    def _test_case_files(self) -> Iterator[Tuple[Dict, IO]]:
+        # the file records with their test case records. The test cases of a
+        # file are written before the file, they are spilled into a temporary
+        # file (a json line each) until the file's record is read, so only
+        # one test case is held at a time
+        pending: Dict[tuple, IO] = {}
+        for record in read_stream(self.log_dir):
+            kind = record.pop('record')
+            # the test cases of a shard are under the shard's record
+            key = (record['file_name'], tuple(record.get('shard') or ()))
+            if kind == 'test_case':
+                record.pop('shard', None)
+                if key not in pending:
+                    pending[key] = tempfile.TemporaryFile('w+')
+                pending[key].write(json.dumps(record) + '\n')
+            else:
+                with pending.pop(key, None) or io.StringIO() as test_cases:
+                    yield record, test_cases
+        # files that did not complete (run crashed or was interrupted)
+        for (file_name, _), test_cases in pending.items():
+            with test_cases:
+                yield {
+                    'file_name': file_name,
+                    'args': {},
+                    'log_dir': '',
+                    'start_time': 'None',
+                    'end_time': 'None',
+                    'duration': 0,
+                }, test_cases
+
+    @staticmethod
+    def _write_test_case_file(fd: IO, record: Dict, test_cases: IO):
+        # the record with its test cases, as json.dump(indent=4) writes it
+        # under "test_case_files", one test case at a time
+        pad = ' ' * 8
+        fd.write(textwrap.indent(json.dumps(record, indent=4)[:-2], pad))
+        fd.write(f',\n{pad}    "test_cases": [')
+        separator = '\n'
+        test_cases.seek(0)
+        for line in test_cases:
+            fd.write(separator)
+            fd.write(textwrap.indent(json.dumps(json.loads(line), indent=4), pad + ' ' * 8))
+            separator = ',\n'
+        if separator == '\n':
+            fd.write(f']\n{pad}}}')
+        else:
+            fd.write(f'\n{pad}    ]\n{pad}}}')
 
     def generate_json_report(self):
+        # written one test case at a time, in the same format as
+        # json.dump(data, indent=4)
+        summary = {
+            'summary': {
+                'total': self.total,
+                'passed': self.passed,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'timeout': self.timeout,
+                'flaky': self.flaky,
+                'quarantined': self.quarantined,
+                'start_time': str(self.start_time),
+                'end_time': str(self.end_time),
+                'duration': self.duration,
+                'log_dir': self.log_dir,
+                **self.phase_summary(),
+                'memory_growth': [{'name': name, 'phase': phase, 'rss_kb': rss_kb}
+                                  for name, phase, rss_kb in self.memory_growth]
+            }
+        }
         json_file_name: str = os.path.join(self.log_dir, 'report.json')
         with open(json_file_name, 'w') as fd:
-            data = {
-                'summary': {
-                    'total': self.total,
-                    'passed': self.passed,
-                    'failed': self.failed,
-                    'skipped': self.skipped,
-                    'start_time': str(self.start_time),
-                    'end_time': str(self.end_time),
-                    'duration': self.duration,
-                    'log_dir': self.log_dir
-                },
-                'test_case_files': self.test_case_files
-            }
-            json.dump(data, fd, default=test_case_to_json, indent=4)
+            fd.write(json.dumps(summary, indent=4)[:-2])
+            fd.write(',\n    "test_case_files": [')
+            separator = '\n'
+            for record, test_cases in self._test_case_files():
+                fd.write(separator)
+                self._write_test_case_file(fd, record, test_cases)
+                separator = ',\n'
+            if separator == '\n':
+                fd.write(']\n}')
+            else:
+                fd.write('\n    ]\n}')
 
     def generate_summary(self):
-        data = f"Total: {self.total}, Passed: {self.passed}, Failed: {self.failed}, Skipped: {self.skipped}\n"
+        data = f"Total: {self.total}, Passed: {self.passed}, Failed: {self.failed}, Skipped: {self.skipped}"
+        if self.timeout:
+            data += f", Timeout: {self.timeout}"
+        if self.flaky:
+            data += f", Flaky: {self.flaky}"
+        if self.quarantined:
+            data += f", Quarantined: {self.quarantined}"
+        data += "\n"
         data += f"Start Time: {self.start_time}, End Time: {self.end_time}\n"
         data += f"Duration: {self.duration} secs\n"
         if len(self.failed_test_cases) > 0:
             data += "\nFailed/Skipped Test Cases:\n"
             ftc_data = []
-            for ftc in self.failed_test_cases:
-                ftc_data.append([ftc.full_name, ftc.error or "Skipped"])
+            for full_name, error in self.failed_test_cases:
+                ftc_data.append([full_name, error or "Skipped"])
             data += tabulate(ftc_data, headers=['Test Case', 'Reason'], tablefmt="grid")
             data += "\n"
+        if self.flaky_test_cases:
+            data += "\nFlaky Test Cases (passed on a rerun):\n"
+            data += tabulate(self.flaky_test_cases, headers=['Test Case', 'Runs'], tablefmt="grid")
+            data += "\n"
+        if self.quarantined_test_cases:
+            data += "\nQuarantined Test Cases (failures not counted):\n"
+            data += tabulate(self.quarantined_test_cases, headers=['Test Case', 'Reason'],
+                             tablefmt="grid")
+            data += "\n"
+        if self.memory_growth:
+            data += f"\nMemory Growth over {self.mem_threshold} MB:\n"
+            data += tabulate([[name, phase, round(rss_kb / 1024, 1)]
+                              for name, phase, rss_kb in self.memory_growth],
+                             headers=['Name', 'Phase', 'RSS Growth (MB)'], tablefmt="grid")
+            data += "\n"
+        phase_summary = self.phase_summary()
+        if phase_summary['slowest']:
+            data += "\nTime by Phase:\n"
+            data += tabulate([[phase, stats['count'], stats['total'], stats['mean'], stats['max']]
+                              for phase, stats in phase_summary['phases'].items()],
+                             headers=['Phase', 'Count', 'Total', 'Mean', 'Max'],
+                             tablefmt="grid", floatfmt=".6f")
+            data += "\n\nSlowest Phases:\n"
+            data += tabulate([[item['name'], item['phase'], item['duration']]
+                              for item in phase_summary['slowest']],
+                             headers=['Name', 'Phase', 'Secs'], tablefmt="grid", floatfmt=".6f")
+            data += "\n"
         summary_file = os.path.join(self.log_dir, 'summary.txt')
         with open(summary_file, 'w') as fd:
             fd.write(data)
         print("\nExecution Summary")
         print("-----------------")
         print(data)
+
+
+if __name__ == "__main__":
+    # build the report of a run from its report.jsonl, e.g. of a run that
+    # was killed before it could build the report
+    # python report.py logs/<timestamp>
+    Report(os.path.abspath(sys.argv[1]))
@@ -0,0 +1,76 @@
+"""
+Resources used by the test case files and the test cases, e.g. a device under
+test or the ports of a traffic generator. A test case file declares them with
+RESOURCES (a literal list) and a test case with the resources decorator
+
+    RESOURCES = ["dut1", "tgen:2"]
+
+is 1 unit of dut1 and 2 units of tgen. A ResourcePool hands out the units of
+each resource, so the work using the same resource does not overlap while the
+rest runs in parallel.
+"""
+
+import threading
+from typing import Dict, Iterable
+
+
+def parse_resources(names: Iterable[str]) -> Dict[str, int]:
+    """
+    ["dut1", "tgen:2"] -> {"dut1": 1, "tgen": 2}
+    """
+    resources: Dict[str, int] = {}
+    for name in names:
+        name, _, count = str(name).partition(':')
+        resources[name] = resources.get(name, 0) + int(count or 1)
+    return resources
+
+
+def merge_resources(*resources: Dict[str, int]) -> Dict[str, int]:
+    """
+    Resources needed to run the work one after another, the most units of
+    each resource
+    """
+    merged: Dict[str, int] = {}
+    for item in resources:
+        for name, count in item.items():
+            merged[name] = max(merged.get(name, 0), count)
+    return merged
+
+
+class ResourcePool:
+    def __init__(self, capacities: Dict[str, int] = None) -> None:
+        # number of units of each resource, 1 for the resources not given
+        self.capacities: Dict[str, int] = dict(capacities or {})
+        self.in_use: Dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    def _requested(self, resources: Dict[str, int]) -> Dict[str, int]:
+        # asking for more units than there are waits for all of them
+        return {name: min(count, self.capacities.get(name, 1))
+                for name, count in resources.items()}
+
+    def try_acquire(self, resources: Dict[str, int]) -> bool:
+        """
+        Take the resources if all of them are free, return False otherwise
+        """
+        requested = self._requested(resources)
+        with self._condition:
+            for name, count in requested.items():
+                if self.in_use.get(name, 0) + count > self.capacities.get(name, 1):
+                    return False
+            for name, count in requested.items():
+                self.in_use[name] = self.in_use.get(name, 0) + count
+            return True
+
+    def acquire(self, resources: Dict[str, int]):
+        """
+        Wait until all the resources are free and take them
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.try_acquire(resources))
+
+    def release(self, resources: Dict[str, int]):
+        with self._condition:
+            for name, count in self._requested(resources).items():
+                self.in_use[name] -= count
+            self._condition.notify_all()
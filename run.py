@@ -1,26 +1,112 @@
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import inspect
 import logging
+import multiprocessing
 import os
-from typing import List
+import re
+import shutil
+import sys
+import time
+import traceback
+from typing import Dict, List, Set
 from types import SimpleNamespace
 
 from tabulate import tabulate
 
 import framework
-from report import Report
+from cancellation import FailureLimit
+from coordinator import Coordinator
+from discovery import DiscoveryCache
+from log_manager import log_manager
+from metrics import MetricsServer
+from report import (QueueReportWriter, Report, ReportStats, ReportWriter,
+                    read_test_case_results, write_profile_summary)
+from resources import ResourcePool, merge_resources
+from scheduler import DurationHistory, predict_run_time
+from selection import Quarantine, Selection
 from testcase import TestCase
 from testcase_file import TestCaseFile
 
 
+# discovered test cases and durations of the earlier runs
+CACHE_DIR = os.path.join('logs', '.taurus-cache')
+# name of the log directory of a run (under logs/), see create_log_dir
+RUN_DIR_PATTERN = re.compile(r'\d{4}(-\d{2}){5}(-\d+)?')
+# how often the test case files are checked for changes (--watch), secs
+WATCH_INTERVAL = 0.2
+
+
+def resource_capacity(value: str) -> tuple:
+    """
+    --resource name=count
+    """
+    name, _, count = value.partition('=')
+    try:
+        count = int(count or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid resource '{value}', expected name=count")
+    if not name or count < 1:
+        raise argparse.ArgumentTypeError(f"invalid resource '{value}', expected name=count")
+    return name, count
+
+
+def byte_size(value: str) -> int:
+    """
+    --log-max-size, bytes with an optional K, M or G suffix
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    scale = units.get(value[-1:].upper(), 1)
+    try:
+        size = int(float(value[:-1] if scale > 1 else value) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}', expected e.g. 512K or 10M")
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}', expected e.g. 512K or 10M")
+    return size
+
+
 class Runner:
     def __init__(self) -> None:
         self.args: SimpleNamespace = None
+        # command line the arguments of the test case files (parse_args of
+        # the file) are parsed from, the runner's own for the worker
+        # processes and the agents
+        self.argv: List[str] = sys.argv[1:]
         self.parser: argparse.ArgumentParser = None
         self.test_case_files: List[TestCaseFile] = []
         self.logger: logging.Logger = None
         self.framework_module_setup_tc: TestCase = None
+        self.report_writer: ReportWriter = None
+        self.selection: Selection = None
+        self.duration_history: DurationHistory = None
+        self.framework_session_setup_tc: TestCase = None
+        self.framework_session_setup_output = None
+        # framework_module_setup shared by the files with the same SETUP_KEY
+        # and the number of files using it that are yet to complete
+        self.shared_module_setups: Dict[str, TestCase] = {}
+        self.shared_module_setup_users: Dict[str, int] = {}
+        # expected duration of the test case files from the earlier runs
+        self.expected_durations: Dict[str, float] = {}
+        # worker -> test case it's running, for the live metrics
+        # (--metrics-port). Shared with the worker processes
+        self.running_test_cases = None
+        # results of the test cases sent by the worker processes as they
+        # complete, written to the report by this process
+        self.results_queue = None
+        # stops the run after --maxfail failed test cases, shared with the
+        # worker processes
+        self.failure_limit: FailureLimit = None
+        # known flaky test cases (--quarantine), read when first needed
+        self.quarantine: Quarantine = None
+        # log directory of the (last) run
+        self.log_dir = ""
+        # with --watch the session setup is run once and the framework module
+        # setup of every file is kept until the runner stops watching
+        self.session_started = False
+        self.keep_module_setups = False
 
     def parse_args(self):
         parser = argparse.ArgumentParser(
@@ -36,9 +122,138 @@ class Runner:
         parser.add_argument(
             '-h', '--help', help='Help Message', action='store_true'
         )
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='Number of test case files to run in parallel worker processes (default 1)'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help='Number of test cases of a file to run at the same time in threads, '
+                 'overridden by CONCURRENCY in the test case file (default 1)'
+        )
+        parser.add_argument(
+            '--max-open-logs', type=int, default=64,
+            help='Maximum number of test case log files kept open at the same time (default 64)'
+        )
+        parser.add_argument(
+            '--async-log', action='store_true',
+            help='Write the logs in a background thread'
+        )
+        parser.add_argument(
+            '--compress-logs', action='store_true',
+            help='Write the log files of the test cases gzip compressed (<name>.gz)'
+        )
+        parser.add_argument(
+            '--log-max-size', type=byte_size, metavar='SIZE',
+            help='Limit the log file of every test case to SIZE (e.g. 10M), keeping the '
+                 'first and the last half of it'
+        )
+        parser.add_argument(
+            '--keep-runs', type=int, metavar='N',
+            help='Keep only the log directories of the last N runs under logs/'
+        )
+        parser.add_argument(
+            '--timeout', type=float,
+            help='Time limit (secs) of every test case and setup/cleanup function, '
+                 'overridden by TIMEOUT in the test case file'
+        )
+        parser.add_argument(
+            '--timeout-method', choices=['thread', 'process'], default='thread',
+            help='Run the functions with a time limit in a thread (abandoned when the time is up) '
+                 'or a forked process (killed when the time is up) (default thread)'
+        )
+        parser.add_argument(
+            '--resource', dest='resources', type=resource_capacity, action='append',
+            default=[], metavar='NAME=COUNT',
+            help='Number of units of a resource declared with RESOURCES or the resources '
+                 'decorator, can be repeated (default 1 unit of each resource)'
+        )
+        parser.add_argument(
+            '--profile', action='store_const', const='*',
+            help='Run the test cases under cProfile. The stats are saved to <test case>.prof '
+                 'next to its log file'
+        )
+        parser.add_argument(
+            '--profile-filter', metavar='PATTERN',
+            help='Profile only the test cases whose name matches the glob pattern (implies --profile)'
+        )
+        parser.add_argument(
+            '--profile-top', type=int, metavar='N',
+            help='Print the N functions that took the most time across the profiled '
+                 'test cases at the end of the run (profiles all the test cases without --profile)'
+        )
+        parser.add_argument(
+            '--mem-threshold', type=float, metavar='MB',
+            help='List the test cases and module setup/cleanup functions that grew the '
+                 'memory (RSS) of the runner by more than MB in the summary'
+        )
+        parser.add_argument(
+            '--metrics-port', type=int, metavar='PORT',
+            help='Serve the live progress of the run in the prometheus text format '
+                 'on http://127.0.0.1:PORT/metrics (0 picks a free port)'
+        )
+        parser.add_argument(
+            '--reruns', type=int, default=0, metavar='N',
+            help='Run a failed test case (with its test case setup/cleanup) again up to N times, '
+                 'flaky if it passes on a rerun'
+        )
+        parser.add_argument(
+            '--reruns-delay', type=float, default=0, metavar='SECS',
+            help='Wait SECS before the first rerun of a test case, twice as long before '
+                 'every rerun after it (default 0)'
+        )
+        parser.add_argument(
+            '--quarantine', metavar='FILE',
+            help='File with the names (module.test_case, glob patterns) of known flaky test '
+                 'cases, one per line. Their failures are reported apart and not counted as failures'
+        )
+        parser.add_argument(
+            '-x', '--exitfirst', action='store_true',
+            help='Stop the run after the first failed test case (same as --maxfail 1)'
+        )
+        parser.add_argument(
+            '--maxfail', type=int, metavar='N',
+            help='Stop the run after N failed test cases, the test cases that are not '
+                 'run are reported as skipped'
+        )
+        parser.add_argument(
+            '--listen', metavar='ADDRESS',
+            help='Run the test case files on the agents (agent.py ADDRESS) that connect to '
+                 'ADDRESS, host:port or unix:path. The agents need the same '
+                 'TAURUS_AGENT_TOKEN in their environment'
+        )
+        parser.add_argument(
+            '--local-agents', type=int, default=0, metavar='N',
+            help='Start N agents on this host for the distributed run (listens on '
+                 '127.0.0.1 with a free port without --listen)'
+        )
+        parser.add_argument(
+            '--watch', action='store_true',
+            help='Run the test case files again whenever they change, until interrupted. '
+                 'The files are run one after another and the framework module setups are '
+                 'kept for the next runs'
+        )
+        parser.add_argument(
+            '-k', dest='keyword',
+            help='Run the test cases whose name/description match the expression, '
+                 'e.g. "addition and not identity"'
+        )
+        parser.add_argument(
+            '--tags',
+            help='Run the test cases whose tags match the expression, e.g. "smoke or sanity"'
+        )
+        parser.add_argument(
+            '--lf', '--last-failed', dest='last_failed', action='store_true',
+            help='Run only the test cases that failed or were skipped in the last run'
+        )
+        parser.add_argument(
+            '--ff', '--failed-first', dest='failed_first', action='store_true',
+            help='Run the test cases that failed or were skipped in the last run first'
+        )
         parser.add_argument(
             'file_list', nargs='*',
-            help='Test Case files, multiple files can be provided'
+            help='Test Case files, multiple files can be provided. '
+                 'Use file.py::test_name to run only the given test case(s) of the file'
         )
         # framework must define a function "parse_args" that takes one
         # parameter (argumentParser)
@@ -47,12 +262,24 @@ class Runner:
         if getattr(framework, 'parse_args', None):
             framework.parse_args(parser)
         self.args, _ = parser.parse_known_args()
+        if self.args.exitfirst:
+            self.args.maxfail = 1
+        if self.args.quarantine:
+            # read by the worker processes from their own cwd
+            self.args.quarantine = os.path.abspath(self.args.quarantine)
+        if self.args.profile_filter:
+            self.args.profile = self.args.profile_filter
+        if self.args.profile_top and self.args.profile is None:
+            self.args.profile = '*'
         self.parser = parser
 
     def parse_test_case_file_args(self, tc_file: TestCaseFile):
         # check if the test case file defines a function "parse_args".
         # If defined, call that function with an argumentParser object.
-        # the function must add all the arguments it expects, into this parser
+        # the function must add all the arguments it expects, into this parser.
+        # dont import the file (yet) if it doesn't define the function
+        if not tc_file.discovered['parse_args']:
+            return
         tc_file_arg_parse_fn = getattr(tc_file.module, 'parse_args', None)
         if not tc_file_arg_parse_fn:
             return
@@ -65,7 +292,7 @@ class Runner:
         # to take the parser argument and add arguments to it using
         # (parser.add_argument)
         tc_file_arg_parse_fn(tc_parser)
-        args, _ = tc_parser.parse_known_args()
+        args, _ = tc_parser.parse_known_args(self.argv)
         tc_file.arg_parser = tc_parser
         # test case might also want to know all the arguments passed by the user
         # for example stop-cleanup, debug etc, so pass everything to the tc
@@ -91,57 +318,345 @@ class Runner:
         return files_list
 
     def load_test_case_files(self):
-        tmp_files_list: List[str] = []
+        try:
+            self.selection = Selection(self.args.keyword, self.args.tags)
+        except ValueError as err:
+            self.parser.error(str(err))
         for fname in self.args.file_list:
+            # file.py::test_name selects the test case(s) of the file
+            fname, _, pattern = fname.partition('::')
             if os.path.isdir(fname):
-                tmp_files_list.extend(self.list_py_files_in_dir(fname))
+                for dir_fname in self.list_py_files_in_dir(fname):
+                    self.selection.add_file(os.path.abspath(dir_fname))
             else:
-                tmp_files_list.append(fname)
-        files_list = tmp_files_list
-        for fname in sorted(files_list):
-            fname = os.path.abspath(fname)
-            tc_file = TestCaseFile(fname)
+                self.selection.add_file(os.path.abspath(fname), pattern or None)
+        failed = {}
+        if self.args.last_failed or self.args.failed_first:
+            failed = self.load_last_failed()
+        if self.args.last_failed and failed and not self.args.file_list:
+            # no files given, run the files of the last run that had failed
+            # test cases (the ones still there)
+            for fname in sorted(failed):
+                if os.path.isfile(fname):
+                    self.selection.add_file(fname)
+        if self.args.last_failed and failed:
+            for fname in list(self.selection.node_ids):
+                if fname in failed:
+                    self.selection.restrict(fname, failed[fname])
+                else:
+                    del self.selection.node_ids[fname]
+        elif self.args.last_failed:
+            print("No failed test cases in the last run, running all the test cases")
+        # test cases of the files that have not changed since the last
+        # run are read from the cache
+        discovery_cache = DiscoveryCache(
+            os.path.join(CACHE_DIR, 'discovery.json'))
+        for fname in sorted(self.selection.node_ids):
+            tc_file = TestCaseFile(fname, discovery_cache)
+            if self.selection.active:
+                tc_file.selection = self.selection
+                # skip the file (and its setup) if none of its test cases are
+                # selected. A file without any test functions in the source
+                # may create them on import, that is checked when it's run
+                if (tc_file.fully_discovered and tc_file.list_test_cases(selected=False) and
+                        not tc_file.list_test_cases()):
+                    continue
+            tc_file.run_first = failed.get(fname, set())
             self.test_case_files.append(tc_file)
+        discovery_cache.save()
+        if self.args.failed_first:
+            # files with failed test cases first, in the sorted order otherwise
+            self.test_case_files.sort(key=lambda f: f.file_name not in failed)
+
+    def load_last_failed(self) -> Dict[str, Set[str]]:
+        """
+        Names of the test cases that failed (or were skipped) in the last run
+        (logs/latest), by test case file
+        """
+        failed: Dict[str, Set[str]] = {}
+        last_log_dir = os.path.join('logs', 'latest')
+        if not os.path.isdir(last_log_dir):
+            return failed
+        for tc in read_test_case_results(last_log_dir):
+            # a flaky test case passed in the end
+            if tc['status'] not in ("passed", "flaky"):
+                failed.setdefault(tc['file_name'], set()).add(tc['name'])
+        return failed
 
     def print_testcases(self):
+        # the test cases are found without importing the files, except the
+        # ones that import or create test case functions (not fully discovered)
         data = []
-        test_cases: List[TestCase] = []
+        idx = 0
+        cwd = os.getcwd()
         for tc_file in self.test_case_files:
-            test_cases.extend(tc_file.get_test_cases())
-        for idx, tc_obj in enumerate(test_cases, 1):
-            data.append([
-                idx, tc_obj.file_name, tc_obj.name, tc_obj.description
-            ])
+            # imported from the directory of the file, like when it's run
+            os.chdir(os.path.dirname(tc_file.file_name))
+            test_cases = tc_file.list_test_cases(imported=True)
+            os.chdir(cwd)
+            for tc in test_cases:
+                idx += 1
+                data.append([
+                    idx, tc_file.file_name, tc['name'], tc['description']
+                ])
         print(tabulate(data, headers=[
               'Id', 'File', 'TestCase', 'Description']))
 
     def create_log_dir(self) -> str:
         start_time = datetime.datetime.now()
         cur_ts = start_time.strftime('%Y-%m-%d-%H-%M-%S')
+        # runs started within the same second (--watch) get a suffix
+        name, count = cur_ts, 0
+        while os.path.exists(os.path.join('logs', name)):
+            count += 1
+            name = f"{cur_ts}-{count}"
+        cur_ts = name
         run_log_dir = os.path.join('logs', cur_ts)
         os.makedirs(run_log_dir, exist_ok=True)
         latest_link = os.path.join('logs', 'latest')
         if os.path.exists(latest_link):
             os.remove(latest_link)
         os.symlink(cur_ts, os.path.join('logs', 'latest'))
+        if self.args.keep_runs:
+            self.remove_old_runs(self.args.keep_runs)
         return run_log_dir
 
+    def remove_old_runs(self, keep: int):
+        # the run directories are named by their timestamp, the oldest sort
+        # first. The cache and the latest link are left alone
+        runs = sorted(name for name in os.listdir('logs')
+                      if RUN_DIR_PATTERN.fullmatch(name) and
+                      not os.path.islink(os.path.join('logs', name)))
+        for name in runs[:-keep]:
+            self.logger.info(f"Removing the logs of the old run {name}")
+            shutil.rmtree(os.path.join('logs', name), ignore_errors=True)
+
     def run_test_case_files(self, log_dir: str = ""):
         if len(self.test_case_files) == 0:
             return
         if not log_dir:
             log_dir = self.create_log_dir()
         log_dir = os.path.abspath(log_dir)
+        self.duration_history = DurationHistory(
+            os.path.join(CACHE_DIR, 'durations.json'))
+        self.schedule_test_case_files()
+        self.report_writer = ReportWriter(log_dir, ReportStats(self.args.mem_threshold))
+        metrics_server, manager = None, None
+        if self.args.workers > 1:
+            manager = multiprocessing.Manager()
+            self.results_queue = manager.Queue()
+        if self.args.maxfail:
+            self.failure_limit = (FailureLimit.shared(manager, self.args.maxfail) if manager
+                                  else FailureLimit(self.args.maxfail))
+        if self.args.metrics_port is not None:
+            self.running_test_cases = manager.dict() if manager else {}
+            metrics_server = MetricsServer(
+                self.args.metrics_port, self.report_writer.stats,
+                [tc_file.file_name for tc_file in self.test_case_files],
+                sum(len(tc_file.list_test_cases()) for tc_file in self.test_case_files),
+                self.args.workers, self.expected_durations, self.running_test_cases)
+            metrics_server.start()
+            self.logger.info(f"Metrics on http://127.0.0.1:{metrics_server.port}/metrics")
         cwd = os.getcwd()
-        for tc_file in self.test_case_files:
+        self.log_dir = log_dir
+        try:
+            if not self.session_started:
+                self.run_framework_session_setup(log_dir)
+                self.session_started = True
+            if self.framework_session_setup_tc and self.framework_session_setup_tc.status != "passed":
+                self.logger.info("Skipping all the test case files")
+                for tc_file in self.test_case_files:
+                    self.report_writer.add_test_case_file(tc_file)
+            elif self.args.listen or self.args.local_agents:
+                self.run_test_case_files_distributed(log_dir)
+            elif self.args.workers > 1:
+                self.run_test_case_files_parallel(log_dir)
+            else:
+                self.count_shared_module_setup_users()
+                for tc_file in self.test_case_files:
+                    os.chdir(cwd)
+                    self.logger.info("")
+                    self.logger.info(f"Planning to run {tc_file.file_name}")
+                    tc_file.report_writer = self.report_writer
+                    self.run_test_case_file(tc_file, log_dir)
+                    self.report_writer.add_test_case_file(tc_file)
+                    self.logger.info(f"Completed running {tc_file.file_name}")
+                    self.logger.info("")
+        finally:
+            # the report is built from the results written so far, even if
+            # the run is interrupted
             os.chdir(cwd)
-            self.logger.info("")
-            self.logger.info(f"Planning to run {tc_file.file_name}")
-            self.run_test_case_file(tc_file, log_dir)
-            self.logger.info(f"Completed running {tc_file.file_name}")
-            self.logger.info("")
-        Report(self.test_case_files, log_dir)
-        self.logger.info(f"Logs {log_dir}")
+            if not self.keep_module_setups:
+                self.run_shared_module_cleanups()
+                self.run_framework_session_cleanup(log_dir)
+            self.report_writer.close()
+            Report(log_dir, self.args.mem_threshold)
+            if self.args.profile_top:
+                print(write_profile_summary(log_dir, self.args.profile_top))
+            self.duration_history.update(log_dir)
+            if metrics_server:
+                metrics_server.stop()
+            if manager:
+                manager.shutdown()
+                self.results_queue = None
+            self.logger.info(f"Logs {log_dir}")
+
+    def schedule_test_case_files(self):
+        # expected duration of the files from the earlier runs. The parallel
+        # workers pick the files longest first, unless the failed files are
+        # asked to run first
+        durations = {}
+        for tc_file in self.test_case_files:
+            names = [tc['name'] for tc in tc_file.list_test_cases()]
+            durations[tc_file.file_name] = self.duration_history.file_duration(
+                tc_file.file_name, names)
+        known = [d for d in durations.values() if d is not None]
+        if not known:
+            return
+        # files that never ran are expected to take as long as an average file
+        average = sum(known) / len(known)
+        for file_name, duration in durations.items():
+            if duration is None:
+                durations[file_name] = average
+        self.expected_durations.update(durations)
+        if self.args.workers > 1 and not self.args.failed_first:
+            self.test_case_files.sort(key=lambda f: -durations[f.file_name])
+        predicted = predict_run_time(
+            [durations[f.file_name] for f in self.test_case_files], self.args.workers)
+        self.logger.info(f"Predicted run time {predicted:.1f} secs "
+                         f"({len(known)}/{len(durations)} files with earlier durations)")
+
+    def get_work_units(self) -> List[List[TestCaseFile]]:
+        """
+        Test case files grouped into the units of work run by a worker
+        process (or an agent), in the scheduled order. The files sharing a
+        framework_module_setup (SETUP_KEY) are one unit, a file with SHARDS
+        is split into that many units
+        """
+        units: Dict[tuple, List[TestCaseFile]] = {}
+        for tc_file in self.test_case_files:
+            if not tc_file.resources_discovered:
+                self.logger.info(
+                    f"Warning: the resources of {tc_file.file_name} (RESOURCES or resources "
+                    f"decorators) are not literals, other workers may use them while it runs")
+            if tc_file.setup_key is None and tc_file.shards > 1:
+                # the test cases of the file are split among the workers,
+                # each shard runs the module setup/cleanup of its own
+                for shard_file in tc_file.split():
+                    units[('shard', tc_file.file_name, shard_file.shard)] = [shard_file]
+            elif tc_file.setup_key is None:
+                units[('file', tc_file.file_name)] = [tc_file]
+            else:
+                units.setdefault(('setup_key', tc_file.setup_key), []).append(tc_file)
+        return list(units.values())
+
+    def run_test_case_files_parallel(self, log_dir: str):
+        # every test case file is run in a worker process. The worker imports
+        # the file again and runs the framework/test module setup and cleanup
+        # on its own, so the chdir done by the test case file only changes the
+        # cwd of that worker. The files sharing a framework_module_setup
+        # (SETUP_KEY) are run one after another by the same worker. The results
+        # sent back by the worker are merged into the test case files of this
+        # process for the report
+        cwd = os.getcwd()
+        units = self.get_work_units()
+        self.logger.info(
+            f"Running {len(self.test_case_files)} test case files with {self.args.workers} workers")
+        # a unit is started when a worker and the resources of its files are
+        # free, in the scheduled order otherwise. A unit waiting for its
+        # resources lets the units after it start
+        pool = ResourcePool(dict(self.args.resources))
+        pending = list(units)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.args.workers) as executor:
+            futures = {}
+            while pending or futures:
+                if self.failure_limit and self.failure_limit.reached:
+                    # no new units, the running ones stop on their own
+                    for unit in pending:
+                        self.skip_stopped_test_case_files(unit)
+                    pending = []
+                for unit in list(pending):
+                    if len(futures) >= self.args.workers:
+                        break
+                    resources = merge_resources(*(tc_file.resources for tc_file in unit))
+                    if not pool.try_acquire(resources):
+                        continue
+                    pending.remove(unit)
+                    for tc_file in unit:
+                        self.logger.info(f"Planning to run {tc_file.file_name}")
+                    future = executor.submit(run_test_case_files_worker,
+                                             [tc_file.file_name for tc_file in unit],
+                                             self.args, log_dir, cwd, unit[0].selection,
+                                             self.framework_session_setup_output,
+                                             self.running_test_cases, unit[0].shard,
+                                             self.failure_limit, self.results_queue, self.argv)
+                    futures[future] = (unit, resources)
+                done, _ = concurrent.futures.wait(
+                    futures, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED)
+                # the results of a unit's test cases are all in the queue
+                # once the unit is done
+                self.report_writer.add_queued_test_cases(self.results_queue)
+                for future in done:
+                    unit, resources = futures.pop(future)
+                    pool.release(resources)
+                    try:
+                        for tc_file, result in zip(unit, future.result()):
+                            tc_file.set_result(result)
+                    except Exception as err:
+                        # the worker process died or the result could not be
+                        # sent back, the test cases of the files are skipped
+                        # with the error
+                        error = ''.join(traceback.format_exception(type(err), err, err.__traceback__))
+                        self.logger.info(
+                            f"Worker failed running {', '.join(f.file_name for f in unit)}\n{error}")
+                        for tc_file in unit:
+                            tc_file.skip_not_imported(f"Not run, the worker failed\n{error}")
+                    for tc_file in unit:
+                        self.report_writer.add_test_case_file(tc_file)
+                        self.logger.info(f"Completed running {tc_file.file_name}")
+
+    def skip_stopped_test_case_files(self, tc_files: List[TestCaseFile]):
+        # files not started when the run was stopped (--maxfail)
+        for tc_file in tc_files:
+            self.logger.info(f"Skipping {tc_file.file_name}, the run was stopped")
+            tc_file.skip_test_cases(self.failure_limit.reason)
+            self.report_writer.add_test_case_file(tc_file)
+
+    def run_test_case_files_distributed(self, log_dir: str):
+        # the units are run by the agents connected to the coordinator, their
+        # logs and results are written into log_dir and the report of this
+        # process
+        units = self.get_work_units()
+        self.logger.info(f"Running {len(self.test_case_files)} test case files on agents")
+        coordinator = Coordinator(self, log_dir, units)
+        coordinator.run(self.args.listen or '127.0.0.1:0', self.args.local_agents)
+
+    def run_framework_session_setup(self, log_dir: str):
+        fn = getattr(framework, 'framework_session_setup', None)
+        if not fn:
+            return
+        self.logger.info("--Running framework_session_setup")
+        fss_tc = TestCase(fn)
+        self.framework_session_setup_tc = fss_tc
+        fss_tc.args = self.args
+        fss_tc.timeout = self.args.timeout
+        fss_tc.timeout_method = self.args.timeout_method
+        self.framework_session_setup_output = fss_tc.run(log_dir)
+        self.logger.info("--Completed framework_session_setup")
+
+    def run_framework_session_cleanup(self, log_dir: str):
+        fn = getattr(framework, 'framework_session_cleanup', None)
+        if not fn or not self.framework_session_setup_tc:
+            return
+        if self.framework_session_setup_tc.status != "passed":
+            return
+        self.logger.info("--Running framework_session_cleanup")
+        tc = TestCase(fn)
+        tc.framework_session_setup_output = self.framework_session_setup_output
+        tc.timeout = self.args.timeout
+        tc.timeout_method = self.args.timeout_method
+        tc.run(log_dir)
+        self.logger.info("--Completed framework_session_cleanup")
 
     def run_framework_module_setup(self, tc_file: TestCaseFile, log_dir: str):
         fn = getattr(framework, 'framework_module_setup', None)
@@ -155,31 +670,129 @@ class Runner:
         fms_tc.args = self.args
         # framework needs to know what test case file/module its working for
         fms_tc.function_args = [tc_file.module]
+        fms_tc.framework_session_setup_output = self.framework_session_setup_output
+        fms_tc.timeout = self.args.timeout
+        fms_tc.timeout_method = self.args.timeout_method
         op = fms_tc.run(log_dir)
         # update tc_file with the output of the framework module setup
         tc_file.framework_module_setup_output = op
+        tc_file.add_hook('framework_module_setup', fms_tc)
         self.logger.info(
             f"--Completed framework_module_setup for {tc_file.file_name}")
 
-    def run_framework_module_cleanup(self, tc_file: TestCase, log_dir: str):
+    def run_framework_module_cleanup(self, fname: str, log_dir: str, fms_tc: TestCase) -> TestCase:
         fn = getattr(framework, 'framework_module_cleanup', None)
         if not fn:
-            return
-        fname = tc_file.file_name
+            return None
         self.logger.info(f"--Running framework_module_cleanup for {fname}")
         tc = TestCase(fn)
-        tc.framework_module_setup_output = self.framework_module_setup_tc.output
+        tc.framework_session_setup_output = self.framework_session_setup_output
+        tc.framework_module_setup_output = fms_tc.output if fms_tc else None
+        tc.timeout = self.args.timeout
+        tc.timeout_method = self.args.timeout_method
         tc.run(log_dir)
         self.logger.info(f"--Completed framework_module_cleanup for {fname}")
+        return tc
+
+    def count_shared_module_setup_users(self):
+        self.shared_module_setup_users = collections.Counter(
+            self.module_setup_key(tc_file) for tc_file in self.test_case_files
+            if tc_file.setup_key is not None)
+
+    def module_setup_key(self, tc_file: TestCaseFile) -> str:
+        # files with a SETUP_KEY share their setup. With --watch every file
+        # keeps its setup for the next runs
+        if tc_file.setup_key is not None:
+            return f"SETUP_KEY {tc_file.setup_key}"
+        if self.keep_module_setups:
+            return f"file {tc_file.file_name}"
+        return None
+
+    def acquire_framework_module_setup(self, tc_file: TestCaseFile, log_dir: str):
+        # run framework module setup before running the test case file, or
+        # reuse the one run for an earlier file with the same SETUP_KEY
+        key = self.module_setup_key(tc_file)
+        if key is not None and key in self.shared_module_setups:
+            self.framework_module_setup_tc = self.shared_module_setups[key]
+            tc_file.framework_module_setup_output = self.framework_module_setup_tc.output
+            self.logger.info(
+                f"--Reusing framework_module_setup of {key} for {tc_file.file_name}")
+            return
+        self.run_framework_module_setup(tc_file, log_dir)
+        if key is not None:
+            self.shared_module_setups[key] = self.framework_module_setup_tc
+
+    def release_framework_module_setup(self, tc_file: TestCaseFile, log_dir: str):
+        # the cleanup of a shared setup is run after the last file using it.
+        # cleanup is not run if the setup failed
+        key = self.module_setup_key(tc_file)
+        if self.keep_module_setups:
+            # cleaned up when the runner stops watching, a failed setup is
+            # run again the next time
+            fms_tc = self.shared_module_setups.get(key)
+            if fms_tc and fms_tc.status != "passed":
+                del self.shared_module_setups[key]
+            return
+        if key is None:
+            fms_tc = self.framework_module_setup_tc
+        else:
+            self.shared_module_setup_users[key] -= 1
+            if self.shared_module_setup_users[key] > 0 or key not in self.shared_module_setups:
+                return
+            fms_tc = self.shared_module_setups.pop(key)
+        if fms_tc and fms_tc.status != "passed":
+            return
+        tc = self.run_framework_module_cleanup(tc_file.file_name, log_dir, fms_tc)
+        if tc:
+            tc_file.add_hook('framework_module_cleanup', tc)
+
+    def run_shared_module_cleanups(self):
+        # shared setups whose files did not all run (run interrupted) and
+        # the setups kept for the next runs (--watch)
+        for key, fms_tc in list(self.shared_module_setups.items()):
+            del self.shared_module_setups[key]
+            if fms_tc is None or fms_tc.status == "passed":
+                self.run_framework_module_cleanup(
+                    key, fms_tc.log_dir if fms_tc else self.log_dir, fms_tc)
 
     def run_test_case_file(self, tc_file: TestCaseFile, run_log_dir: str):
-        # create a subdir for the tc file (module) under run_log_dir
-        tc_file_log_dir = os.path.join(
-            run_log_dir, inspect.getmodulename(tc_file.file_name))
-        # run framework module setup before running the test case file
-        self.run_framework_module_setup(tc_file, tc_file_log_dir)
+        # create a subdir for the tc file (module) under run_log_dir. The
+        # shards of a file run at the same time, each gets a subdir of its own
+        module_name = inspect.getmodulename(tc_file.file_name)
+        if tc_file.shard:
+            module_name = f"{module_name}.shard{tc_file.shard[0]}"
+        tc_file_log_dir = os.path.join(run_log_dir, module_name)
+        try:
+            tc_file.module
+        except Exception:
+            # the test cases are reported with the error and the run goes on
+            # with the next file
+            error = traceback.format_exc()
+            self.logger.info(
+                f"--Skipping test case file {tc_file.file_name}, it could not be imported\n{error}")
+            tc_file.skip_not_imported(error)
+            if tc_file.setup_key is not None:
+                self.release_framework_module_setup(tc_file, tc_file_log_dir)
+            return
+        if (tc_file.selection or tc_file.shard) and not tc_file.count_test_cases():
+            self.logger.info(
+                f"--Skipping test case file {tc_file.file_name}, no test cases selected")
+            if tc_file.setup_key is not None:
+                self.release_framework_module_setup(tc_file, tc_file_log_dir)
+            return
+        if self.failure_limit and self.failure_limit.reached:
+            self.logger.info(
+                f"--Skipping test case file {tc_file.file_name}, the run was stopped")
+            tc_file.skip_test_cases(self.failure_limit.reason)
+            if tc_file.setup_key is not None:
+                self.release_framework_module_setup(tc_file, tc_file_log_dir)
+            return
+        self.parse_test_case_file_args(tc_file)
+        tc_file.framework_session_setup_output = self.framework_session_setup_output
+        self.acquire_framework_module_setup(tc_file, tc_file_log_dir)
         if self.framework_module_setup_tc and self.framework_module_setup_tc.status != "passed":
             self.logger.info(f"--Skipping test case file {tc_file.file_name}")
+            self.release_framework_module_setup(tc_file, tc_file_log_dir)
             return
         # if the framework has test_case_setup (and cleanup)
         # inform the tc_file to run these functions at the start/end
@@ -190,38 +803,174 @@ class Runner:
         cleanup_fn = getattr(framework, 'framework_case_cleanup', None)
         if cleanup_fn:
             tc_file.framework_case_cleanup_tc = TestCase(cleanup_fn)
-        tc_count = len(tc_file.get_test_cases())
+        tc_file.timeout = getattr(tc_file.module, 'TIMEOUT', self.args.timeout)
+        tc_file.resource_pool = ResourcePool(dict(self.args.resources))
+        tc_file.profile = self.args.profile
+        tc_file.running_test_cases = self.running_test_cases
+        tc_file.failure_limit = self.failure_limit
+        tc_file.reruns = self.args.reruns
+        tc_file.reruns_delay = self.args.reruns_delay
+        if self.args.quarantine and self.quarantine is None:
+            self.quarantine = Quarantine.load(self.args.quarantine)
+        tc_file.quarantine = self.quarantine
+        # test case file can stop running its test cases after MAXFAIL of
+        # them failed
+        tc_file.maxfail = getattr(tc_file.module, 'MAXFAIL', None)
+        tc_file.timeout_method = self.args.timeout_method
+        # test case file can define how many of its test cases can run
+        # at the same time
+        tc_file.concurrency = getattr(
+            tc_file.module, 'CONCURRENCY', self.args.concurrency)
+        if tc_file.concurrency > 1 and self.duration_history:
+            for name in tc_file.test_case_names():
+                duration = self.duration_history.test_case_duration(
+                    tc_file.file_name, name)
+                if duration is not None:
+                    tc_file.expected_durations[name] = duration
+        tc_count = tc_file.count_test_cases()
         self.logger.info(
             f"--Found {tc_count} test cases in {tc_file.file_name}")
         tc_file.run_test_cases(tc_file_log_dir)
         self.logger.info(
             f"--Completed {tc_count} test cases in {tc_file.file_name}")
-        self.run_framework_module_cleanup(tc_file, tc_file_log_dir)
+        self.release_framework_module_setup(tc_file, tc_file_log_dir)
+
+    def watch_test_case_files(self):
+        # run the files, then run a file again whenever it changes until
+        # interrupted. A changed file is imported again (the other files stay
+        # imported), the session setup and the framework module setups are
+        # kept from the first run and cleaned up at the end
+        if self.args.workers > 1 or self.args.listen or self.args.local_agents:
+            self.logger.info("Watching runs the files one after another in this process")
+            self.args.workers, self.args.listen, self.args.local_agents = 1, None, 0
+        self.keep_module_setups = True
+        tc_files = {tc_file.file_name: tc_file for tc_file in self.test_case_files}
+        mtimes = {file_name: os.stat(file_name).st_mtime_ns for file_name in tc_files}
+        try:
+            while True:
+                try:
+                    self.run_test_case_files()
+                except Exception:
+                    # e.g. a file saved half way, it's run again when it's
+                    # saved the next time
+                    self.logger.exception("Run failed")
+                self.logger.info(
+                    f"Watching {len(tc_files)} test case files for changes, Ctrl-C to stop")
+                changed = []
+                while not changed:
+                    time.sleep(WATCH_INTERVAL)
+                    for file_name, mtime in mtimes.items():
+                        try:
+                            current = os.stat(file_name).st_mtime_ns
+                        except FileNotFoundError:
+                            # being saved (replaced), seen on the next check
+                            continue
+                        if current != mtime:
+                            mtimes[file_name] = current
+                            changed.append(file_name)
+                self.test_case_files = []
+                for file_name in changed:
+                    self.logger.info(f"Changed {file_name}")
+                    tc_file = TestCaseFile(file_name)
+                    try:
+                        tc_file.discovered
+                    except Exception:
+                        # syntax error, not run until it's fixed
+                        self.logger.exception(f"Could not read {file_name}")
+                        continue
+                    tc_file.selection = tc_files[file_name].selection
+                    tc_files[file_name] = tc_file
+                    self.test_case_files.append(tc_file)
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching")
+        finally:
+            self.keep_module_setups = False
+            self.run_shared_module_cleanups()
+            if self.session_started:
+                self.run_framework_session_cleanup(self.log_dir)
 
     def _create_logger(self):
+        log_manager.max_open_files = self.args.max_open_logs
+        log_manager.compress = self.args.compress_logs
+        log_manager.max_bytes = self.args.log_max_size
+        if self.args.async_log:
+            log_manager.start_writer()
         logger = logging.getLogger("runner")
+        self.logger = logger
+        if logger.handlers:
+            # already created, e.g. a forked worker process inherits the
+            # runner logger of its parent
+            return
         logger.setLevel(logging.DEBUG)
         handler = logging.StreamHandler()
         handler.setLevel(logging.DEBUG)
         formatter = logging.Formatter("%(asctime)s %(message)s",
                                       datefmt="%Y-%m-%d-%H:%M:%S")
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        self.logger = logger
+        log_manager.add_handler(logger, handler)
 
     def main(self):
         self.parse_args()
         self.load_test_case_files()
-        self.parse_test_case_files_args()
+        # the test case files are imported only to run them or to get
+        # their arguments for the help
         if self.args.list:
             self.print_testcases()
         elif self.args.help:
+            self.parse_test_case_files_args()
             self.print_help()
+        elif self.args.watch:
+            self._create_logger()
+            self.watch_test_case_files()
         else:
             self._create_logger()
             self.run_test_case_files()
 
 
+def run_test_case_files_worker(file_names: List[str], args: argparse.Namespace,
+                               log_dir: str, cwd: str, selection: Selection = None,
+                               framework_session_setup_output=None,
+                               running_test_cases=None, shard: tuple = None,
+                               failure_limit: FailureLimit = None,
+                               results_queue=None, argv: List[str] = None) -> List[dict]:
+    """
+    Run the test case files in a worker process (--workers) and return the
+    results of the files and their test cases. The result of every test case
+    is also put in results_queue as soon as it completes. The arguments of
+    the test case files are parsed from argv, the runner's command line
+    """
+    runner = Runner()
+    runner.args = args
+    if argv is not None:
+        runner.argv = argv
+    runner._create_logger()
+    runner.duration_history = DurationHistory(
+        os.path.join(cwd, CACHE_DIR, 'durations.json'))
+    runner.framework_session_setup_output = framework_session_setup_output
+    runner.running_test_cases = running_test_cases
+    runner.failure_limit = failure_limit
+    runner.log_dir = log_dir
+    for file_name in file_names:
+        tc_file = TestCaseFile(file_name)
+        tc_file.selection = selection
+        tc_file.shard = shard
+        if results_queue is not None:
+            tc_file.report_writer = QueueReportWriter(results_queue)
+        runner.test_case_files.append(tc_file)
+    runner.count_shared_module_setup_users()
+    results = []
+    for tc_file in runner.test_case_files:
+        os.chdir(cwd)
+        runner.run_test_case_file(tc_file, log_dir)
+        results.append(tc_file.get_result())
+    os.chdir(cwd)
+    runner.run_shared_module_cleanups()
+    # the worker process does not run the exit handlers, write out the
+    # logs queued by the files before returning
+    log_manager.flush()
+    return results
+
+
 if __name__ == "__main__":
     runner = Runner()
     runner.main()
@@ -0,0 +1,97 @@
+"""
+Schedule the test case files using the durations of the earlier runs. The
+durations of the test case files and the test cases of the last few runs are
+kept on the disk (DurationHistory). With parallel workers the files are run
+longest first, which keeps the slowest worker from finishing long after the
+others, and the run time is predicted from the expected durations.
+"""
+
+import heapq
+import json
+import os
+from typing import Dict, Iterable, List
+
+from report import read_stream
+
+
+class DurationHistory:
+    def __init__(self, history_file: str, size: int = 5) -> None:
+        self.history_file = history_file
+        # number of runs kept per file/test case
+        self.size = size
+        # file name -> durations, "file name::test case name" -> durations
+        self.files: Dict[str, List[float]] = {}
+        self.test_cases: Dict[str, List[float]] = {}
+        try:
+            with open(history_file) as fd:
+                data = json.load(fd)
+            self.files = data['files']
+            self.test_cases = data['test_cases']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def _mean(durations: List[float]) -> float:
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def test_case_duration(self, file_name: str, name: str) -> float:
+        return self._mean(self.test_cases.get(f"{file_name}::{name}"))
+
+    def file_duration(self, file_name: str, test_case_names: Iterable[str] = ()) -> float:
+        """
+        Expected duration of the file, from the file's durations or else from
+        the durations of its test cases. None if the file was never run
+        """
+        duration = self._mean(self.files.get(file_name))
+        if duration is not None:
+            return duration
+        durations = [self.test_case_duration(file_name, name)
+                     for name in test_case_names]
+        durations = [d for d in durations if d is not None]
+        if not durations:
+            return None
+        return sum(durations)
+
+    def _add(self, durations: Dict[str, List[float]], key: str, duration):
+        if not isinstance(duration, (int, float)):
+            # not run (skipped)
+            return
+        durations.setdefault(key, []).append(duration)
+        del durations[key][:-self.size]
+
+    def update(self, log_dir: str):
+        """
+        Add the durations of the run in log_dir and save the history. The
+        duration of a file split into shards is the sum of the shards
+        """
+        file_durations: Dict[str, float] = {}
+        for record in read_stream(log_dir):
+            if record['end_time'] == "None":
+                continue
+            if record['record'] == 'test_case':
+                key = f"{record['file_name']}::{record['name']}"
+                self._add(self.test_cases, key, record['duration'])
+            elif isinstance(record['duration'], (int, float)):
+                file_durations[record['file_name']] = (
+                    file_durations.get(record['file_name'], 0) + record['duration'])
+        for file_name, duration in file_durations.items():
+            self._add(self.files, file_name, duration)
+        try:
+            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+            with open(self.history_file, 'w') as fd:
+                json.dump({'files': self.files, 'test_cases': self.test_cases}, fd)
+        except OSError:
+            pass
+
+
+def predict_run_time(durations: List[float], workers: int) -> float:
+    """
+    Run time of the given durations run in this order by the workers, each
+    one picking the next when it's free
+    """
+    loads = [0.0] * max(workers, 1)
+    for duration in durations:
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
@@ -0,0 +1,148 @@
+"""
+Select the test cases to run. Test cases can be selected by
+
+* node id - file.py::test_case_name given instead of the file name, the name
+  can be a glob pattern (file.py::test_check_*). A parametrized test case is
+  test_name[values], test_name selects all of its values and the values can
+  be a glob pattern too (file.py::test_send[r1-*])
+* keyword expression (-k) - words matched (case insensitive) against the test
+  case name (module.test_case) and its doc string, combined with and/or/not
+  and parentheses, e.g. "addition and not identity"
+* tag expression (--tags) - tags given to the test case function with the
+  testcase.tags decorator, combined the same way, e.g. "smoke or sanity"
+* last failed (--last-failed) - test cases that failed (or were skipped) in
+  the last run
+"""
+
+import fnmatch
+import inspect
+import re
+from typing import Callable, Dict, Iterable, List, Set
+
+
+class Expression:
+    def __init__(self, expr: str) -> None:
+        self.expr = expr
+        # every word other than the operators is turned into a call to the
+        # match function, so the expression can only evaluate the matches
+        code = []
+        for token in re.findall(r'\(|\)|[^\s()]+', expr):
+            if token in ('(', ')', 'and', 'or', 'not'):
+                code.append(token)
+            else:
+                code.append(f'_match({token!r})')
+        try:
+            self.code = compile(' '.join(code), '<expression>', 'eval')
+        except SyntaxError:
+            raise ValueError(f"Invalid expression '{expr}'")
+
+    def __reduce__(self):
+        # code object can't be pickled, compile again in the worker process
+        return (Expression, (self.expr,))
+
+    def evaluate(self, match: Callable[[str], bool]) -> bool:
+        return bool(eval(self.code, {'__builtins__': {}}, {'_match': match}))
+
+
+def _match_name(name: str, pattern: str) -> bool:
+    # the [values] of a parametrized test case are matched on their own, so
+    # the brackets are not taken as a glob character set
+    base, _, values = name.partition('[')
+    if '[' not in pattern:
+        return fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(base, pattern)
+    pattern_base, _, pattern_values = pattern.partition('[')
+    return (fnmatch.fnmatchcase(base, pattern_base) and
+            fnmatch.fnmatchcase(values[:-1], pattern_values.rstrip(']')))
+
+
+class Selection:
+    def __init__(self, keyword: str = None, tags: str = None) -> None:
+        self.keyword: Expression = Expression(keyword) if keyword else None
+        self.tags: Expression = Expression(tags) if tags else None
+        # test case name patterns given as file.py::name, by file. None if
+        # the file was given without names (all the test cases)
+        self.node_ids: Dict[str, List[str]] = {}
+        # names of the test cases a file is restricted to, e.g. the ones
+        # that failed in the last run (--last-failed)
+        self.restricted: Dict[str, Set[str]] = {}
+
+    def to_json(self) -> Dict:
+        """
+        Selection sent to the agents (distributed run)
+        """
+        return {
+            'keyword': self.keyword.expr if self.keyword else None,
+            'tags': self.tags.expr if self.tags else None,
+            'node_ids': self.node_ids,
+            'restricted': {file_name: sorted(names) for file_name, names in self.restricted.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'Selection':
+        selection = cls(data['keyword'], data['tags'])
+        selection.node_ids = data['node_ids']
+        for file_name, names in data['restricted'].items():
+            selection.restrict(file_name, names)
+        return selection
+
+    def add_file(self, file_name: str, pattern: str = None):
+        if pattern is None:
+            self.node_ids[file_name] = None
+        elif self.node_ids.get(file_name, []) is not None:
+            self.node_ids.setdefault(file_name, []).append(pattern)
+
+    def restrict(self, file_name: str, names: Iterable[str]):
+        self.restricted[file_name] = set(names)
+
+    @property
+    def active(self) -> bool:
+        """
+        True if the selection deselects any test case
+        """
+        return bool(self.keyword or self.tags or self.restricted or
+                    any(patterns is not None for patterns in self.node_ids.values()))
+
+    def selects(self, file_name: str, name: str, description: str,
+                tags: Iterable[str]) -> bool:
+        if file_name in self.restricted and name not in self.restricted[file_name]:
+            return False
+        patterns = self.node_ids.get(file_name)
+        if patterns is not None:
+            if not any(name == pattern or _match_name(name, pattern)
+                       for pattern in patterns):
+                return False
+        if self.keyword:
+            text = f"{inspect.getmodulename(file_name)}.{name} {description or ''}".lower()
+            if not self.keyword.evaluate(lambda word: word.lower() in text):
+                return False
+        if self.tags:
+            tags = set(tags)
+            if not self.tags.evaluate(lambda tag: tag in tags):
+                return False
+        return True
+
+
+class Quarantine:
+    """
+    Known flaky test cases (--quarantine FILE). The file has a test case
+    full name (module.test_case, can be a glob pattern like selection's node
+    ids) per line, # starts a comment. Quarantined test cases are run, their
+    failures are reported on their own and don't count as failures of the run
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        self.patterns: List[str] = list(patterns)
+
+    @classmethod
+    def load(cls, file_name: str) -> 'Quarantine':
+        patterns = []
+        with open(file_name) as fd:
+            for line in fd:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    patterns.append(line)
+        return cls(patterns)
+
+    def __contains__(self, full_name: str) -> bool:
+        return any(full_name == pattern or _match_name(full_name, pattern)
+                   for pattern in self.patterns)
@@ -1,18 +1,176 @@
 import argparse
+import asyncio
+import cProfile
 import datetime
 import inspect
+import itertools
 import json
+import math
 import logging
+import multiprocessing
 import os
+import threading
+import time
 import traceback
 from types import FunctionType
-from typing import List
+from typing import Dict, Iterator, List
+
+from log_manager import log_manager
+from usage import sample_usage, usage_difference
+
+
+def tags(*names: str):
+    """
+    Decorator to tag a test case function. The tags can be used to select
+    the test cases to run (--tags)
+    """
+    def decorator(function: FunctionType) -> FunctionType:
+        function.tags = set(getattr(function, 'tags', set())) | set(names)
+        return function
+    return decorator
+
+
+def timeout(seconds: float):
+    """
+    Decorator to limit the time a test case (or setup/cleanup) function can
+    run. Overrides the TIMEOUT of the module and the --timeout of the runner
+    """
+    def decorator(function: FunctionType) -> FunctionType:
+        function.timeout = seconds
+        return function
+    return decorator
+
+
+def resources(*names: str):
+    """
+    Decorator to declare the resources a test case uses, e.g.
+    @resources("dut1", "tgen:2"). Test cases of a module running concurrently
+    wait for each other's resources
+    """
+    def decorator(function: FunctionType) -> FunctionType:
+        function.resources = list(getattr(function, 'resources', [])) + list(names)
+        return function
+    return decorator
+
+
+def parametrize(**params):
+    """
+    Decorator to run a test case function for every combination of the
+    given values, e.g. @parametrize(device=["r1", "r2"], size=[64, 1500]) runs
+    test_x[r1-64], test_x[r1-1500], test_x[r2-64] and test_x[r2-1500]. The
+    values of the test case are in tc.params. The test cases are created one
+    at a time as they are run
+    """
+    def decorator(function: FunctionType) -> FunctionType:
+        function.params = {**getattr(function, 'params', {}),
+                           **{name: list(values) for name, values in params.items()}}
+        return function
+    return decorator
+
+
+def expand_params(params: Dict[str, List]) -> Iterator[Dict]:
+    """
+    Every combination of the parametrize values, one at a time
+    """
+    names = list(params)
+    for values in itertools.product(*params.values()):
+        yield dict(zip(names, values))
+
+
+def count_params(params: Dict[str, List]) -> int:
+    return math.prod(len(values) for values in params.values())
+
+
+def param_id(params: Dict) -> str:
+    """
+    Part of the test case name for the parametrize values, also used in the
+    name of its log file
+    """
+    return '-'.join(str(value).replace(os.sep, '_').replace(' ', '_')
+                    for value in params.values())
+
+
+class TestCaseTimeout(Exception):
+    pass
+
+
+class TestCaseResult:
+    """
+    Result of a test case, kept in place of the TestCase once it's run. It
+    has only what goes into the report, the function, the outputs and the
+    logger of the test case are dropped with the TestCase. Also what a worker
+    process sends back to the runner
+    """
+    __slots__ = ('file_name', 'name', 'full_name', 'params', 'args', 'description', 'tags',
+                 'resources', 'start_time', 'end_time', 'duration', 'phases', 'usage',
+                 'status', 'error', 'timeout', 'attempts', 'quarantined', 'log_file',
+                 'profile_file', 'log_dir')
+
+    def __init__(self, tc: 'TestCase') -> None:
+        for attr in self.__slots__:
+            setattr(self, attr, getattr(tc, attr))
+        # an empty set takes more memory than a tuple
+        self.tags = tuple(sorted(self.tags))
+
+    def result(self) -> 'TestCaseResult':
+        return self
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'TestCaseResult':
+        """
+        Result sent as json by an agent (distributed run) or a worker. The
+        times are kept as str, the args may be left out
+        """
+        result = cls.__new__(cls)
+        for attr in cls.__slots__:
+            setattr(result, attr, data.get(attr))
+        result.args = argparse.Namespace(**(data.get('args') or {}))
+        result.tags = tuple(data['tags'])
+        return result
+
+    def __repr__(self) -> str:
+        return json.dumps(self.to_json(), indent=4)
+
+    def to_json(self):
+        """
+        JSON Encoder
+        """
+        return {
+            'file_name': self.file_name,
+            'name': self.name,
+            'full_name': self.full_name,
+            'params': self.params,
+            'args': self.args.__dict__ or {},
+            'description': self.description,
+            'tags': sorted(self.tags),
+            'resources': self.resources,
+            'start_time': str(self.start_time),
+            'end_time': str(self.end_time),
+            'duration': self.duration,
+            'phases': self.phases,
+            'usage': self.usage,
+            'status': self.status,
+            'error': self.error,
+            'timeout': self.timeout,
+            'attempts': self.attempts,
+            'quarantined': self.quarantined,
+            'log_file': self.log_file,
+            'profile_file': self.profile_file,
+            'log_dir': self.log_dir
+        }
 
 
 class TestCase():
-    def __init__(self, tc_function: FunctionType):
-        self.file_name: str = inspect.getfile(tc_function)
+    def __init__(self, tc_function: FunctionType, params: Dict = None, file_name: str = None):
+        # test case file that runs the function, a function imported from
+        # another module belongs to the file that imports it
+        self.file_name: str = file_name or inspect.getfile(tc_function)
         self.name: str = tc_function.__name__
+        # values of a parametrized test case (see parametrize), they are
+        # part of its name
+        self.params: Dict = params or {}
+        if self.params:
+            self.name = f"{self.name}[{param_id(self.params)}]"
         self.full_name: str = inspect.getmodulename(
             self.file_name) + '.' + self.name
         self.function: FunctionType = tc_function
@@ -21,22 +179,54 @@ class TestCase():
         # function. usually used by framework functions
         self.function_args = []
         self.description: str = inspect.getdoc(tc_function)
+        self.tags = set(getattr(tc_function, 'tags', set()))
+        # resources the test case uses, see the resources module
+        self.resources: List[str] = list(getattr(tc_function, 'resources', []))
         self.start_time: datetime.datetime = None
         self.end_time: datetime.datetime = None
         self.duration: int = ""
+        # time (secs, monotonic clock) taken by each phase of the run that
+        # was not skipped, by role (framework_case_setup, test_case_setup,
+        # function, test_case_cleanup, framework_case_cleanup)
+        self.phases: Dict[str, float] = {}
+        # resource usage of the process during the run, see usage.py
+        self.usage: Dict[str, float] = {}
         self.status: str = ""
         self.error: str = ""
+        # times a failed (or timed out) test case is run again (--reruns),
+        # waiting reruns_delay secs before the first rerun and twice as long
+        # before each one after it. Status, error, start time and duration of
+        # every run when it's rerun, the status is flaky if it passed on a rerun
+        self.reruns: int = 0
+        self.reruns_delay: float = 0
+        self.attempts: List[Dict] = []
+        # failed but known to be flaky (--quarantine), not counted as failed
+        self.quarantined: bool = False
         self.logger: logging.Logger = ""
         self.log_dir: str = ""
         self.log_file: str = ""
         # the cli args (argparse.Namespace)
         self.args: argparse.Namespace = argparse.Namespace()
+        # time limit (secs) of the functions run by this test case, unless the
+        # function sets its own with the timeout decorator. The function is run
+        # in a thread (or a forked process) that's abandoned (or killed) when
+        # the time is up
+        self.timeout: float = None
+        self.timeout_method: str = "thread"
+        # set when a function run in a thread times out. The thread keeps
+        # running, a function can check this to stop its work
+        self.timed_out = threading.Event()
+        # run the test case function under cProfile (--profile), the stats
+        # are saved to profile_file (<name>.prof next to the log file)
+        self.profile: bool = False
+        self.profile_file: str = ""
         # different init/cleanup test cases that can be run
         self.framework_case_setup_tc: TestCase = None
         self.test_case_setup_tc: TestCase = None
         self.framework_case_cleanup_tc: TestCase = None
         self.test_case_cleanup_tc: TestCase = None
         # outputs from different init functions that are run before the test case
+        self.framework_session_setup_output = ""
         self.framework_module_setup_output = ""
         self.test_module_setup_output = ""
         self.framework_case_setup_output = ""
@@ -74,7 +264,11 @@ class TestCase():
         try:
             # no pre condition or precondition has passed
             if pre is None or self._state[pre] == "passed":
-                output = tc.function(self, *function_args)
+                start = time.monotonic()
+                try:
+                    output = self._call(tc, function_args)
+                finally:
+                    self.phases[role] = self.phases.get(role, 0) + time.monotonic() - start
                 if post:
                     self._state[post] = "passed"
             else:
@@ -82,10 +276,17 @@ class TestCase():
                     f"----Skipping {info_str} as pre-condition {pre} failed/skipped")
                 self.logger.info(
                     f"Skipping {info_str} as pre-condition {pre} failed/skipped")
-                self.status = "failed"
+                self._set_status("failed")
                 self._state[post] = "skipped"
+        except TestCaseTimeout as err:
+            self._set_status("timeout")
+            if post:
+                self._state[post] = "timeout"
+            self.error = f"Timeout: {err}"
+            rlog.error(f"----Timeout {info_str}: {err}")
+            self.logger.error(f"Timeout {info_str}: {err}")
         except Exception as err:
-            self.status = "failed"
+            self._set_status("failed")
             if post:
                 self._state[post] = "failed"
             self.error = traceback.format_exc()
@@ -96,10 +297,166 @@ class TestCase():
         rlog.info(f"----Completed {info_str}")
         return output
 
+    def _set_status(self, status: str):
+        # a timeout is kept over the failures that follow it (e.g. the test
+        # case skipped after its setup timed out)
+        if self.status != "timeout":
+            self.status = status
+
+    def _call_function(self, tc: 'TestCase', function_args: List):
+        # profiled here, in the thread (or process) that runs the function
+        profiler = None
+        if tc is self and self.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as err:
+                # python 3.12+ runs one profiler at a time, a concurrent
+                # test case is being profiled
+                self.logger.info(f"Not profiling {self.full_name}: {err}")
+                profiler = None
+        try:
+            output = tc.function(self, *function_args)
+            if inspect.iscoroutine(output):
+                # async def function, run it to completion on an event
+                # loop of this thread
+                output = asyncio.run(output)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_file)
+        return output
+
+    def _call(self, tc: 'TestCase', function_args: List):
+        timeout = getattr(tc.function, 'timeout', self.timeout)
+        if not timeout:
+            return self._call_function(tc, function_args)
+        if self.timeout_method == "process":
+            return self._call_in_process(tc, function_args, timeout)
+        return self._call_in_thread(tc, function_args, timeout)
+
+    def _call_in_thread(self, tc: 'TestCase', function_args: List, timeout: float):
+        result = {}
+
+        def target():
+            try:
+                result['output'] = self._call_function(tc, function_args)
+            except BaseException as err:
+                result['error'] = err
+
+        thread = threading.Thread(target=target, name=tc.full_name, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            self.timed_out.set()
+            raise TestCaseTimeout(f"{tc.full_name} did not complete in {timeout} secs")
+        if 'error' in result:
+            raise result['error']
+        return result.get('output')
+
+    def _call_in_process(self, tc: 'TestCase', function_args: List, timeout: float):
+        # the function is run in a forked process that is killed when the time
+        # is up. It runs on a copy of this test case, so only its output
+        # (which must be picklable) and its logs come back
+        ctx = multiprocessing.get_context('fork')
+        reader, writer = ctx.Pipe(duplex=False)
+        # the process writes into the log file of the test case too. The
+        # records logged so far are written and the file is closed, each
+        # process writes a gzip member of its own (--compress-logs). The
+        # process exits without closing its files, it closes the log file
+        # and sends back what it kept for the tail (--log-max-size)
+        log_manager.flush()
+        handler = log_manager.file_handler(self.log_file)
+        if handler:
+            handler.close_stream()
+
+        def target():
+            log_manager.after_fork()
+            try:
+                result = ('output', self._call_function(tc, function_args))
+            except BaseException:
+                result = ('error', traceback.format_exc())
+            log_manager.flush()
+            state = None
+            if handler:
+                handler.close_stream()
+                state = handler.get_state()
+            try:
+                writer.send(result + (state,))
+            except Exception:
+                writer.send(('output', None, state))
+
+        process = ctx.Process(target=target, name=tc.full_name, daemon=True)
+        process.start()
+        writer.close()
+        try:
+            if not reader.poll(timeout):
+                process.kill()
+                raise TestCaseTimeout(
+                    f"{tc.full_name} did not complete in {timeout} secs, killed process {process.pid}")
+            try:
+                kind, value, state = reader.recv()
+            except EOFError:
+                raise Exception(
+                    f"Process {process.pid} running {tc.full_name} exited with {process.exitcode}")
+        finally:
+            process.join()
+            reader.close()
+        if handler and state:
+            handler.set_state(state)
+        if kind == 'error':
+            raise Exception(f"{tc.full_name} failed in process {process.pid}\n{value}")
+        return value
+
     def run(self, log_dir: str):
+        start_usage = sample_usage()
         self.start_time = datetime.datetime.now()
         self.logger = self._create_logger(log_dir)
+        if self.profile:
+            self.profile_file = os.path.join(self.log_dir, self.name + '.prof')
         self.logger.info(f'Start Test Case {self.full_name}')
+        for attempt in range(self.reruns + 1):
+            if attempt:
+                delay = self.reruns_delay * 2 ** (attempt - 1)
+                self.logger.info(f'Rerun {attempt} of {self.full_name} in {delay} secs, '
+                                 f'status {self.status}')
+                logging.getLogger("runner").info(
+                    f"----Rerun {attempt} of {self.full_name}, status {self.status}")
+                time.sleep(delay)
+                self._reset()
+            attempt_start = datetime.datetime.now()
+            self._run_once()
+            if self.reruns:
+                self.attempts.append({
+                    'status': self.status,
+                    'error': self.error,
+                    'start_time': str(attempt_start),
+                    'duration': (datetime.datetime.now() - attempt_start).total_seconds(),
+                })
+            if self.status == "passed":
+                break
+        if self.status == "passed" and len(self.attempts) > 1:
+            self.status = "flaky"
+        self.end_time = datetime.datetime.now()
+        self.duration = (self.end_time - self.start_time).total_seconds()
+        self.logger.info('End test Case %s, Status %s',
+                         self.full_name, self.status)
+        log_manager.release(self.log_file)
+        # after the log file is closed, which is not the test case's fd
+        self.usage = usage_difference(start_usage, sample_usage())
+        return self.output
+
+    def _reset(self):
+        # state of the earlier run cleared before a rerun. The time of the
+        # phases adds up over the runs
+        self.status = ""
+        self.error = ""
+        self.output = None
+        self.timed_out = threading.Event()
+        for key in self._state:
+            self._state[key] = "passed"
+
+    def _run_once(self):
         # run the init/setup functions
         self.framework_case_setup_output = self._run_tc(
             self.framework_case_setup_tc, role='framework_case_setup',
@@ -120,29 +477,22 @@ class TestCase():
         # mark it as passed
         if self.status == "":
             self.status = "passed"
-        self.end_time = datetime.datetime.now()
-        self.duration = (self.end_time - self.start_time).total_seconds()
-        self.logger.info('End test Case %s, Status %s',
-                         self.full_name, self.status)
-        return self.output
 
     def _create_logger(self, log_dir: str) -> logging.Logger:
         """
-        Create a FileHandler logger object. If stdout is True, add
-        an additional streamhandler in the logger.
+        Get the logger of the test case's log file from the log manager.
+        The log file is closed by the log manager at the end of the run
         """
         self.log_dir = log_dir
-        self.log_file = os.path.join(log_dir, self.name)
+        self.log_file = log_manager.log_file_name(os.path.join(log_dir, self.name))
         os.makedirs(self.log_dir, exist_ok=True)
-        logger = logging.getLogger(self.log_file)
-        logger.setLevel(logging.DEBUG)
-        handler = logging.FileHandler(self.log_file)
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s",
-                                      datefmt="%Y-%m-%d-%H:%M:%S")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return logger
+        return log_manager.get_logger(self.log_file)
+
+    def result(self) -> TestCaseResult:
+        """
+        Compact copy of the result of the test case, see TestCaseResult
+        """
+        return TestCaseResult(self)
 
     def __repr__(self) -> str:
         return json.dumps(self.to_json(), indent=4)
@@ -151,17 +501,4 @@ class TestCase():
         """
         JSON Encoder
         """
-        return {
-            'file_name': self.file_name,
-            'name': self.name,
-            'full_name': self.full_name,
-            'args': self.args.__dict__ or {},
-            'description': self.description,
-            'start_time': str(self.start_time),
-            'end_time': str(self.end_time),
-            'duration': self.duration,
-            'status': self.status,
-            'error': self.error,
-            'log_file': self.log_file,
-            'log_dir': self.log_dir
-        }
+        return self.result().to_json()
@@ -1,13 +1,22 @@
 import argparse
+import concurrent.futures
 import datetime
+import fnmatch
 import inspect
 import importlib.util
+import itertools
+import json
 import logging
 import os
-from typing import List
+import threading
+from typing import Dict, Iterator, List, Set, Tuple
 from types import ModuleType
 
-from testcase import TestCase
+from cancellation import FailureLimit
+from discovery import DiscoveryCache, discover_file
+from resources import ResourcePool, merge_resources, parse_resources
+from selection import Quarantine, Selection
+from testcase import TestCase, TestCaseResult, expand_params, param_id
 
 
 def import_file(file_path: str):
@@ -24,16 +33,66 @@ def import_file(file_path: str):
 
 
 class TestCaseFile(object):
-    def __init__(self, file_name: str) -> None:
+    def __init__(self, file_name: str, discovery_cache: DiscoveryCache = None) -> None:
         self._special_test_cases = ["test_module_setup", "test_module_cleanup",
                                     "test_case_setup", "test_case_cleanup"]
         self.file_name: str = file_name
-        self.module: ModuleType = import_file(file_name)
-        self.test_case_list: List[TestCase] = self._load_test_cases()
+        # the file is imported (and its test cases loaded) when they are
+        # first accessed, listing the test cases uses the discovered ones
+        self._module: ModuleType = None
+        # the TestCase of a test case is replaced by its TestCaseResult once
+        # it's run. Position of each test case in the list, by name
+        self._test_case_list: List[TestCase] = None
+        self._test_case_index: Dict[str, int] = {}
+        # results of the test cases of the parametrized functions, by name
+        self._results: Dict[str, object] = {}
+        self._discovered: Dict = None
+        self._discovery_cache = discovery_cache
         # filled by run.py when it loads the framework
+        self.framework_session_setup_output = None
         self.framework_module_setup_output = None
         self.framework_case_setup_tc: TestCase = None
         self.framework_case_cleanup_tc: TestCase = None
+        # number of test cases of this file that are run at the same time
+        self.concurrency: int = 1
+        # resources of the test cases (resources decorator), test cases that
+        # run concurrently wait for the resources used by the others
+        self.resource_pool: ResourcePool = None
+        self._resources: Dict[str, int] = None
+        # worker -> test case it's running (live metrics), set by run.py
+        self.running_test_cases = None
+        # report.ReportWriter that the test cases are written to as they complete
+        self.report_writer = None
+        # test cases selected to run, all if not set
+        self.selection: Selection = None
+        # names of the test cases to run before the others (--failed-first)
+        self.run_first: Set[str] = set()
+        # (index, count) to run only every count'th test case starting at
+        # index, the file is split into SHARDS run by different workers
+        self.shard: Tuple[int, int] = None
+        self._shard_applied = False
+        # time limit of the test cases and the module's setup/cleanup functions
+        # (TIMEOUT of the module or --timeout) and how it's enforced
+        self.timeout: float = None
+        self.timeout_method: str = "thread"
+        # test cases to run under the profiler (--profile), a glob pattern
+        # of the test case (full) name. None to not profile
+        self.profile: str = None
+        # failed test cases after which the run is stopped (--maxfail), set
+        # by run.py. And after which the rest of this file is not run (MAXFAIL
+        # of the module)
+        self.failure_limit: FailureLimit = None
+        self.maxfail: int = None
+        self.failures: int = 0
+        self._failures_lock = threading.Lock()
+        # failed test cases are run again (--reruns), see TestCase.reruns
+        self.reruns: int = 0
+        self.reruns_delay: float = 0
+        # known flaky test cases whose failures don't count (--quarantine)
+        self.quarantine: Quarantine = None
+        # expected duration of the test cases by name, from the earlier runs.
+        # concurrent test cases are started longest first
+        self.expected_durations: Dict[str, float] = {}
         # store this for convenience as its accessed by test case
         self.test_module_setup_tc: TestCase = None
         # cli argument parser (added by run.py during the run)
@@ -43,8 +102,140 @@ class TestCaseFile(object):
         self.start_time: datetime.datetime = None
         self.end_time: datetime.datetime = None
         self.duration: int = 0
+        # time (secs) taken by the module setup/cleanup functions of the
+        # framework and the test case file, by function name
+        self.hooks: Dict[str, float] = {}
+        # resource usage of the same functions (see usage.py)
+        self.hook_usage: Dict[str, Dict] = {}
         self.logger = logging.getLogger("runner")
 
+    @property
+    def module(self) -> ModuleType:
+        if self._module is None:
+            self._module = import_file(self.file_name)
+        return self._module
+
+    @property
+    def test_case_list(self) -> List[TestCase]:
+        if self._test_case_list is None:
+            self._set_test_case_list(self._load_test_cases())
+        return self._test_case_list
+
+    def _set_test_case_list(self, test_cases: List[TestCase]):
+        self._test_case_list = test_cases
+        self._test_case_index = {tc.name: idx for idx, tc in enumerate(test_cases)}
+
+    @property
+    def discovered(self) -> Dict:
+        """
+        Test cases and special functions of the file found without importing
+        it (see discovery.discover_file)
+        """
+        if self._discovered is None:
+            if self._discovery_cache:
+                self._discovered = self._discovery_cache.discover(self.file_name)
+            else:
+                self._discovered = discover_file(self.file_name)
+        return self._discovered
+
+    @property
+    def setup_key(self) -> str:
+        """
+        Files with the same SETUP_KEY (a literal value) share one
+        framework_module_setup. None if the file does not set it
+        """
+        constants = self.discovered['constants']
+        if 'SETUP_KEY' not in constants:
+            return None
+        return json.dumps(constants['SETUP_KEY'], sort_keys=True)
+
+    @property
+    def resources(self) -> Dict[str, int]:
+        """
+        Resources used by the file, RESOURCES of the file (a literal list,
+        e.g. ["dut1", "tgen:2"]) and the resources decorators of its selected
+        test cases. The worker running the file holds them all, so the test
+        cases don't overlap with the files run by the other workers
+        """
+        if self._resources is None:
+            resources = [parse_resources(self.discovered['constants'].get('RESOURCES', []))]
+            resources.extend(parse_resources(tc.get('resources') or [])
+                             for tc in self.list_test_cases())
+            self._resources = merge_resources(*resources)
+        return self._resources
+
+    @property
+    def resources_discovered(self) -> bool:
+        """
+        False if RESOURCES or the resources of some test cases are not
+        literals, they are known only when the file is imported
+        """
+        return ('RESOURCES' not in self.discovered['dynamic_constants'] and
+                all(tc.get('resources') is not None for tc in self.discovered['test_cases']))
+
+    @property
+    def shards(self) -> int:
+        """
+        Number of parts (SHARDS of the file) the test cases are split into
+        to run in parallel workers
+        """
+        return self.discovered['constants'].get('SHARDS', 1)
+
+    @property
+    def fully_discovered(self) -> bool:
+        """
+        False if the names of some test cases are known only when the file
+        is imported (parametrize values that are not literals, or test case
+        functions imported or created by the module)
+        """
+        return (not self.discovered.get('dynamic_test_cases') and
+                all(tc.get('params') is not None for tc in self.discovered['test_cases']))
+
+    def split(self) -> List['TestCaseFile']:
+        """
+        The file split into its shards, each a TestCaseFile of its own
+        """
+        shards = []
+        for index in range(self.shards):
+            tc_file = TestCaseFile(self.file_name, self._discovery_cache)
+            tc_file._discovered = self._discovered
+            tc_file.selection = self.selection
+            tc_file.run_first = self.run_first
+            tc_file.shard = (index, self.shards)
+            shards.append(tc_file)
+        return shards
+
+    def _listed_test_cases(self) -> Iterator[Dict]:
+        for tc in self.discovered['test_cases']:
+            if tc['name'] in self._special_test_cases:
+                continue
+            if not tc.get('params'):
+                yield tc
+                continue
+            for params in expand_params(tc['params']):
+                yield {**tc, 'name': f"{tc['name']}[{param_id(params)}]", 'params': params}
+
+    def list_test_cases(self, selected: bool = True, imported: bool = False) -> List[Dict]:
+        """
+        Name, description and tags of the (selected) test cases, without
+        importing the file. With imported, a file that is not fully
+        discovered is imported to list the test cases it runs
+        """
+        if selected and imported and not self.fully_discovered:
+            return [{'name': name, 'description': tc.description, 'tags': sorted(tc.tags),
+                     'resources': tc.resources, 'params': params or {}}
+                    for name, tc, params in self._entries()]
+        test_cases = [tc for tc in self._listed_test_cases()
+                      if not selected or self._selected(tc['name'], tc['description'], tc['tags'])]
+        if self.run_first:
+            test_cases.sort(key=lambda tc: tc['name'] not in self.run_first)
+        return test_cases
+
+    def _selected(self, name: str, description: str, tags) -> bool:
+        if not self.selection:
+            return True
+        return self.selection.selects(self.file_name, name, description, tags)
+
     def _load_test_cases(self) -> List[TestCase]:
         func_list = inspect.getmembers(self.module, inspect.isfunction)
         test_case_list: List[TestCase] = []
@@ -52,27 +243,77 @@ class TestCaseFile(object):
             # get all the functions that start with test_
             if not func_name.startswith('test_'):
                 continue
-            testcase_obj = TestCase(func_obj)
+            testcase_obj = TestCase(func_obj, file_name=self.file_name)
             test_case_list.append(testcase_obj)
         return test_case_list
 
-    def _find_test_case(self, test_case_name: str) -> TestCase:
-        matched_tc = None
+    def _entries(self) -> Iterator[Tuple[str, TestCase, Dict]]:
+        # (name, test case, params) of the selected test cases in the order
+        # they are run. The test case of a parametrized function is the
+        # TestCase of the function, with the params of each combination
+        entries = self._selected_entries()
+        if self.run_first:
+            entries = itertools.chain(
+                (entry for entry in self._selected_entries() if entry[0] in self.run_first),
+                (entry for entry in entries if entry[0] not in self.run_first))
+        for idx, entry in enumerate(entries):
+            if self.shard and not self._shard_applied and idx % self.shard[1] != self.shard[0]:
+                continue
+            yield entry
+
+    def _selected_entries(self) -> Iterator[Tuple[str, TestCase, Dict]]:
         for tc in self.test_case_list:
-            if tc.name == test_case_name:
-                matched_tc = tc
-                break
-        return matched_tc
+            if tc.name in self._special_test_cases:
+                continue
+            if isinstance(tc, TestCase) and not tc.params and getattr(tc.function, 'params', None):
+                for params in expand_params(tc.function.params):
+                    name = f"{tc.name}[{param_id(params)}]"
+                    if self._selected(name, tc.description, tc.tags):
+                        yield name, tc, params
+            elif self._selected(tc.name, tc.description, tc.tags):
+                yield tc.name, tc, None
+
+    def iter_test_cases(self) -> Iterator[TestCase]:
+        """
+        Selected test cases in the order they are run, the ones that were run
+        are their TestCaseResult. The test cases of a parametrized function are
+        created one at a time
+        """
+        for name, tc, params in self._entries():
+            if params is None:
+                yield tc
+            else:
+                yield self._results.get(name) or TestCase(tc.function, params, self.file_name)
+
+    def test_case_names(self) -> Iterator[str]:
+        for name, _, _ in self._entries():
+            yield name
+
+    def count_test_cases(self) -> int:
+        return sum(1 for _ in self._entries())
+
+    def _find_test_case(self, test_case_name: str) -> TestCase:
+        idx = self._test_case_index.get(test_case_name) if self.test_case_list else None
+        if idx is None:
+            return None
+        return self.test_case_list[idx]
 
     def get_test_cases(self, special=False) -> List[TestCase]:
         if special == True:
             return self.test_case_list
-        test_cases = []
-        for tc in self.test_case_list:
-            if tc.name in self._special_test_cases:
-                continue
-            test_cases.append(tc)
-        return test_cases
+        return list(self.iter_test_cases())
+
+    def _prepare(self, tc: TestCase):
+        tc.framework_session_setup_output = self.framework_session_setup_output
+        tc.timeout = self.timeout
+        tc.timeout_method = self.timeout_method
+
+    def add_hook(self, name: str, tc: TestCase):
+        """
+        Keep the time and the resource usage of a module setup/cleanup run
+        """
+        self.hooks[name] = sum(tc.phases.values())
+        self.hook_usage[name] = tc.usage
 
     def run_test_module_setup(self):
         self.test_module_setup_tc = self._find_test_case("test_module_setup")
@@ -82,12 +323,92 @@ class TestCaseFile(object):
             f"--Running test_module_setup from {self.file_name}")
         # pass the output of the framework module setup into this
         self.test_module_setup_tc.framework_module_setup_output = self.framework_module_setup_output
+        self._prepare(self.test_module_setup_tc)
         self.test_module_setup_tc.run(self.log_dir)
+        self.add_hook('test_module_setup', self.test_module_setup_tc)
         self.logger.info(
             f"--Completed test_module_setup from {self.file_name}")
 
+    def stop_reason(self) -> str:
+        """
+        Why the test cases that were not started are not run (MAXFAIL of the
+        file or --maxfail reached), None to run them
+        """
+        if self.maxfail and self.failures >= self.maxfail:
+            return f"Not run, {self.failures} test cases of the file failed (MAXFAIL {self.maxfail})"
+        if self.failure_limit and self.failure_limit.reached:
+            return self.failure_limit.reason
+        return None
+
+    def skip_test_cases(self, reason: str):
+        """
+        Keep the test cases that were not run as skipped, with the reason
+        """
+        for tc in self.iter_test_cases():
+            if isinstance(tc, TestCase) and not tc.status:
+                tc.error = reason
+                self._store_result(tc)
+
+    def skip_not_imported(self, reason: str):
+        """
+        Keep the (discovered) test cases as skipped with the reason when the
+        file could not be imported, or its worker failed. The file is not
+        imported for these
+        """
+        module_name = inspect.getmodulename(self.file_name)
+        test_cases = []
+        for tc in self.list_test_cases():
+            test_cases.append(TestCaseResult.from_json({
+                'file_name': self.file_name, 'name': tc['name'],
+                'full_name': f"{module_name}.{tc['name']}", 'params': tc.get('params') or {},
+                'args': {}, 'description': tc['description'], 'tags': tc['tags'],
+                'resources': [], 'duration': "", 'phases': {}, 'usage': {}, 'status': "",
+                'error': reason, 'attempts': [], 'quarantined': False,
+                'log_file': "", 'profile_file': "", 'log_dir': "",
+            }))
+        if self.shard:
+            test_cases = test_cases[self.shard[0]::self.shard[1]]
+        self._set_test_case_list(test_cases)
+        self._shard_applied = True
+        if self.report_writer:
+            for tc in test_cases:
+                self.report_writer.add_test_case(tc, self.shard)
+
+    def release(self):
+        """
+        Drop the results of the test cases and the module once they are
+        written to the report, a file that was run only keeps what's needed
+        to list it
+        """
+        self._set_test_case_list([])
+        self._results = {}
+        self._shard_applied = True
+        self._module = None
+        self.test_module_setup_tc = None
+        self.framework_case_setup_tc = None
+        self.framework_case_cleanup_tc = None
+
+    def _store_result(self, tc: TestCase):
+        # only the result is kept from here on
+        result = tc.result()
+        if tc.name in self._test_case_index:
+            self.test_case_list[self._test_case_index[tc.name]] = result
+        else:
+            self._results[tc.name] = result
+        if self.report_writer:
+            self.report_writer.add_test_case(result, self.shard)
+
     def run_test_case(self, tc: TestCase):
-        # let the test case know about the other init/cleanup tests that it need to run
+        reason = self.stop_reason()
+        if reason:
+            self.logger.info(f"--Skipping test_case {tc.name} from {self.file_name}, {reason}")
+            tc.error = reason
+            self._store_result(tc)
+            return
+        # let the test case know about the other init/cleanup tests that it need to run.
+        # these helper test cases are shared by all the test cases of the file, they
+        # are never run on their own and only their function/name are used by the
+        # test case, so they are safe to share when the test cases run concurrently
         tc.framework_case_setup_tc = self.framework_case_setup_tc
         tc.framework_case_cleanup_tc = self.framework_case_cleanup_tc
         tc.test_case_setup_tc = self._find_test_case("test_case_setup")
@@ -97,9 +418,35 @@ class TestCaseFile(object):
         if self.test_module_setup_tc:
             tc.test_module_setup_output = self.test_module_setup_tc.output
         tc.args = self.args
+        tc.reruns = self.reruns
+        tc.reruns_delay = self.reruns_delay
+        self._prepare(tc)
+        tc.profile = self.profile is not None and (
+            fnmatch.fnmatchcase(tc.full_name, self.profile) or
+            fnmatch.fnmatchcase(tc.name, self.profile))
         self.logger.info(
             f"--Running test_case {tc.name} from {self.file_name}")
-        tc.run(self.log_dir)
+        resources = parse_resources(tc.resources)
+        if self.resource_pool and resources:
+            self.resource_pool.acquire(resources)
+        worker = f"{os.getpid()}/{threading.current_thread().name}"
+        if self.running_test_cases is not None:
+            self.running_test_cases[worker] = tc.full_name
+        try:
+            tc.run(self.log_dir)
+        finally:
+            if self.running_test_cases is not None:
+                self.running_test_cases.pop(worker, None)
+            if self.resource_pool and resources:
+                self.resource_pool.release(resources)
+        if tc.status in ("failed", "timeout") and self.quarantine and tc.full_name in self.quarantine:
+            tc.quarantined = True
+        if tc.status not in ("passed", "flaky", "") and not tc.quarantined:
+            with self._failures_lock:
+                self.failures += 1
+            if self.failure_limit and self.failure_limit.add():
+                self.logger.info(f"--Stopping the run, {self.failure_limit.maxfail} test cases failed")
+        self._store_result(tc)
         self.logger.info(
             f"--Completed test_case {tc.name} from {self.file_name}")
 
@@ -111,9 +458,11 @@ class TestCaseFile(object):
             # pass the output of the module_setup, so the cleanup can take care of any cleanup
             # required for the output
             test_module_cleanup_tc.test_module_setup_output = self.test_module_setup_tc.output
+        self._prepare(test_module_cleanup_tc)
         self.logger.info(
             f"--Running test_module_cleanup from {self.file_name}")
         test_module_cleanup_tc.run(self.log_dir)
+        self.add_hook('test_module_cleanup', test_module_cleanup_tc)
         self.logger.info(
             f"--Completed test_module_cleanup from {self.file_name}")
 
@@ -126,20 +475,83 @@ class TestCaseFile(object):
             # dont run other test cases if the module's setup failed
             self.logger.info(f"--Skipping test case file {self.file_name}")
             return
-        for tc in self.get_test_cases():
-            self.run_test_case(tc)
+        test_cases = self.iter_test_cases()
+        if self.concurrency > 1:
+            # all the test cases run in the same directory (changed above)
+            # so the threads share the cwd, test cases must not change it
+            self.logger.info(
+                f"--Running test cases from {self.file_name} with concurrency {self.concurrency}")
+            if self.expected_durations and not self._parametrized():
+                test_cases = iter(sorted(
+                    test_cases, key=lambda tc: -self.expected_durations.get(tc.name, 0)))
+            self._run_concurrently(test_cases)
+        else:
+            for tc in test_cases:
+                self.run_test_case(tc)
         self.run_test_module_cleanup()
         self.end_time = datetime.datetime.now()
         self.duration = (self.end_time - self.start_time).total_seconds()
 
-    def to_json(self):
-        # test case has its own json encoder
+    def _parametrized(self) -> bool:
+        return any(isinstance(tc, TestCase) and getattr(tc.function, 'params', None)
+                   for tc in self.test_case_list)
+
+    def _run_concurrently(self, test_cases: Iterator[TestCase]):
+        # the next test case is taken (and created) only when a thread is
+        # free, so only the running test cases exist at a time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            running = set()
+            for tc in test_cases:
+                if len(running) >= self.concurrency:
+                    done, running = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                running.add(executor.submit(self.run_test_case, tc))
+            for future in concurrent.futures.as_completed(running):
+                future.result()
+
+    def get_result(self) -> dict:
+        """
+        Results of the test case file run, along with the results of each of
+        its test cases (TestCaseResult)
+        """
         return {
+            'args': self.args,
+            'log_dir': self.log_dir,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': self.duration,
+            'hooks': self.hooks,
+            'hook_usage': self.hook_usage,
+            'test_cases': [tc.result() for tc in self.iter_test_cases()]
+        }
+
+    def set_result(self, result: dict):
+        # the results replace the test cases, the file is not imported
+        self.args = result['args']
+        self.log_dir = result['log_dir']
+        self.start_time = result['start_time']
+        self.end_time = result['end_time']
+        self.duration = result['duration']
+        self.hooks = result['hooks']
+        self.hook_usage = result['hook_usage']
+        self._set_test_case_list(result['test_cases'])
+        # the results are of this file's shard only
+        self._shard_applied = True
+
+    def to_json(self):
+        # the test cases are written to the report on their own
+        data = {
             'file_name': self.file_name,
             'args': self.args.__dict__ or {},
             'log_dir': self.log_dir,
             'start_time': str(self.start_time),
             'end_time': str(self.end_time),
             'duration': self.duration,
-            'test_cases': self.get_test_cases()
+            'hooks': self.hooks,
+            'hook_usage': self.hook_usage,
         }
+        if self.shard:
+            data['shard'] = list(self.shard)
+        return data
@@ -0,0 +1,68 @@
+"""
+Resource usage of the runner process: memory (RSS), CPU time, open file
+descriptors and threads. A sample is taken before and after every test case
+and module setup/cleanup, the difference is kept in its usage. The values are
+of the whole process, so test cases running at the same time (CONCURRENCY)
+see the usage of each other.
+
+Read from /proc on linux, from the resource module elsewhere (the peak RSS
+instead of the current one, no fds and threads).
+"""
+
+import os
+import resource
+import sys
+import threading
+from typing import Dict
+
+
+def _proc_status() -> Dict[str, int]:
+    # VmRSS (kB) and Threads from /proc/self/status
+    status = {}
+    with open('/proc/self/status') as fd:
+        for line in fd:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def sample_usage() -> Dict[str, float]:
+    """
+    Current usage of the process: rss_kb, user_cpu and system_cpu (secs),
+    fds and threads (None where not available)
+    """
+    times = os.times()
+    usage = {
+        'rss_kb': None,
+        'user_cpu': times.user,
+        'system_cpu': times.system,
+        'fds': None,
+        'threads': threading.active_count(),
+    }
+    try:
+        status = _proc_status()
+        usage['rss_kb'] = status.get('VmRSS')
+        usage['threads'] = status.get('Threads', usage['threads'])
+        usage['fds'] = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on mac, kB elsewhere
+        usage['rss_kb'] = maxrss // 1024 if sys.platform == 'darwin' else maxrss
+    return usage
+
+
+def usage_difference(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    """
+    Usage between the samples, along with the rss at the end (rss_end_kb)
+    """
+    delta = {}
+    for key, value in after.items():
+        if value is None or before.get(key) is None:
+            delta[key] = None
+        elif isinstance(value, float):
+            delta[key] = round(value - before[key], 6)
+        else:
+            delta[key] = value - before[key]
+    delta['rss_end_kb'] = after['rss_kb']
+    return delta